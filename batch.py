@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+'''
+Batch Book Dimension Measurement
+==================
+
+Runs the headless measurement (measure.py) over a directory or a glob of images,
+spread over a pool of worker processes. Each image needs its corner sidecar
+(<image>.json or <image>.csv, see measure.py), or only the book corners with --qr.
+With --auto the book corners are detected, and with --auto --qr no sidecar is
+needed at all; records below --min_confidence get review=true.
+
+One JSON record is written per image, as soon as it is done, so records may come
+out of order. Every record carries the path of its input image. With --output
+ending in .npz, .parquet or .arrow the records are written in columnar chunks
+of --chunk_records instead, .csv gives flat rows (see results.py).
+
+With --io_threads, reading and decoding run on that many threads and only the
+measurement runs in the process pool, with bounded queues in between (see
+pipeline.py). This overlaps I/O with compute on slow (network) storage.
+
+With --timings, each record gets the wall time, CPU time (and with --memory
+the peak allocation) of every pipeline stage; --prometheus also writes their
+totals in Prometheus text format. --profile runs only the first image, under
+cProfile.
+
+With --table (or --payload_size) the real size of each QR reference comes from
+its payload (see reference_table.py); payloads not in the table are only parsed
+for their size with --payload_size. Every worker loads the table once, and the
+hash of the table file is part of the cache key.
+
+With --ref_pixels the working scale is chosen per image from the size of the
+reference in it (see measure.adaptive_image); each record carries its scale.
+
+With --robust the lengths come from a robust fit over all reference points and
+QR codes in each image, with width_std and height_std (see robust.py).
+
+With --cache, results are kept in a SQLite file keyed by image and sidecar
+contents plus all parameters (see cache.py); unchanged images are not decoded again.
+
+Usage
+-----
+batch.py --images [<directory or glob>] --real_width [<real_width>] --real_height [<real_height>]
+         [--qr --qr_size <qr_size> [--table <sizes.json> | --payload_size]]
+         [--auto [--min_confidence 0.5]] [--robust] [--scale 0.125 | --max_side <pixels>] [--ref_pixels <pixels>] [--refine]
+         [--workers N] [--chunksize N | --io_threads N [--queue_size N]] [--output results.jsonl|.csv|.npz|.parquet|.arrow [--append]]
+         [--cache <results.sqlite> [--cache_size <MB>]]
+         [--timings [--memory] [--prometheus <metrics.prom>]] [--profile]
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+import instrument
+import measure
+import reference_table
+import results
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# one cache connection per worker process
+_caches = {}
+
+# options which do not change the result, left out of cache keys
+NON_PIPELINE_OPTIONS = ('cache', 'cache_bytes', 'timings', 'memory')
+
+def get_cache(options):
+    path = options.get('cache')
+    if not path:
+        return None
+    if path not in _caches:
+        # sqlite is only loaded when caching
+        from cache import DEFAULT_MAX_BYTES, ResultCache
+        _caches[path] = ResultCache(path, options.get('cache_bytes') or DEFAULT_MAX_BYTES)
+    return _caches[path]
+
+def get_sizes(options):
+    '''
+    Reference sizes of the options (reference_table.load_sizes), loaded once
+    per process.
+    '''
+    return reference_table.load_sizes(options.get('table'), options.get('payload_size', False))
+
+def list_images(source):
+    '''
+    Images in a directory (non recursive), or matched by a glob pattern, sorted.
+    '''
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS))
+
+def measure_one(job):
+    '''
+    Worker: measure a single image, never raises. job is (image_path, options).
+    '''
+    image_path, options = job
+    record = {'image': image_path}
+    if options.get('timings'):
+        instrument.enable(memory=options.get('memory', False))
+        instrument.begin(image_path)
+    try:
+        return _measure_one(image_path, options, record)
+    finally:
+        timings = instrument.end()
+        if timings is not None:
+            record['timings'] = timings['stages']
+
+def sidecar_optional(options):
+    '''
+    True when both quads can come from the image itself.
+    '''
+    return bool(options.get('auto') and (options['qr'] or options.get('target')))
+
+def result_key(image_path, quads_path, options):
+    '''
+    Cache key of an image, its sidecar and the pipeline options.
+    '''
+    from cache import cache_key, file_hash
+
+    params = dict((k, v) for k, v in options.items() if k not in NON_PIPELINE_OPTIONS)
+    params['size'] = measure.DEST_SIZE
+    params['quads'] = file_hash(quads_path) if quads_path else None
+    if params.get('table'):
+        params['table'] = file_hash(params['table'])
+    if params.get('target'):
+        # the saved features, not where they are stored
+        params['target'] = file_hash(params['target'])
+    return cache_key(image_path, params)
+
+def _measure_one(image_path, options, record):
+    quads_path = measure.find_sidecar(image_path)
+    if quads_path is None and not sidecar_optional(options):
+        record.update(status='error', error='no corner sidecar found')
+        return record
+
+    cache = get_cache(options)
+    if cache is not None:
+        try:
+            key = result_key(image_path, quads_path, options)
+        except (IOError, OSError) as e:
+            record.update(status='error', error=str(e))
+            return record
+        result = cache.get(key)
+        if result is not None:
+            record.update(result)
+            record.setdefault('status', 'ok')
+            record['cached'] = True
+            return record
+
+    try:
+        result, warped = measure.measure_file(image_path, quads_path,
+                                              options['real_width'], options['real_height'],
+                                              options['scale'], qr=options['qr'],
+                                              max_side=options.get('max_side'),
+                                              refine=options.get('refine', False),
+                                              target=options.get('target'),
+                                              sizes=get_sizes(options),
+                                              auto=options.get('auto', False),
+                                              min_confidence=options.get('min_confidence', 0.5),
+                                              robust=options.get('robust', False),
+                                              ref_pixels=options.get('ref_pixels'))
+    except measure.ReferenceNotFound as e:
+        # remembered, so the image is not searched again on the next run
+        record.update(status='error', error=str(e), no_reference=True)
+        if cache is not None:
+            cache.put(key, {'status': 'error', 'error': str(e), 'no_reference': True})
+        return record
+    except Exception as e:
+        record.update(status='error', error=str(e))
+        return record
+
+    if cache is not None:
+        cache.put(key, result)
+    record.update(result)
+    record['status'] = 'ok'
+    return record
+
+def run(paths, options, workers=None, chunksize=1):
+    '''
+    Measure all images in a process pool. Yields one record per image,
+    in completion order.
+    '''
+    jobs = [(path, options) for path in paths]
+    if workers == 1:
+        for job in jobs:
+            yield measure_one(job)
+        return
+
+    # the size table is loaded once per worker, not sent with every job
+    pool = multiprocessing.Pool(workers, get_sizes, (options,))
+    try:
+        for record in pool.imap_unordered(measure_one, jobs, chunksize):
+            yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Batch book dimension measurement")
+    ap.add_argument("-i", "--images", required=True, help="Directory or glob of images")
+    ap.add_argument("-w", "--real_width", type=float, help="Real Width")
+    ap.add_argument("-H", "--real_height", type=float, help="Real Height")
+    ap.add_argument("-s", "--scale", type=float, default=0.125, help="Working resolution scale")
+    ap.add_argument("-m", "--max_side", type=int, help="Pick the scale per image, longer side in pixels")
+    ap.add_argument("--ref_pixels", type=int,
+                    help="Pick the smallest scale per image at which the reference is this many pixels across")
+    ap.add_argument("-r", "--refine", action="store_true",
+                    help="Refine corners on the full resolution image")
+    ap.add_argument("--qr", action="store_true", help="Use the QR code in the image as reference")
+    ap.add_argument("--qr_size", type=float, help="Real side length of the printed QR code")
+    ap.add_argument("--table", help="JSON/CSV table of QR payload -> real reference size")
+    ap.add_argument("--payload_size", action="store_true",
+                    help="Read the real reference size from the QR payload (e.g. REF-4cm), "
+                         "with --table for payloads not in it")
+    ap.add_argument("-a", "--auto", action="store_true",
+                    help="Detect the book corners when the sidecar has none")
+    ap.add_argument("--min_confidence", type=float, default=0.5,
+                    help="With --auto, flag results below this detection confidence for review")
+    ap.add_argument("--robust", action="store_true",
+                    help="Fit the reference homography robustly to all reference points and fuse references")
+    ap.add_argument("--target", help="Saved feature target (.npz) to find the reference with")
+    ap.add_argument("-j", "--workers", type=int, default=None,
+                    help="Number of worker processes (default: number of CPUs)")
+    ap.add_argument("-c", "--chunksize", type=int, default=4, help="Images handed to a worker at once")
+    ap.add_argument("-t", "--io_threads", type=int, default=0,
+                    help="Decode on this many threads, measure in the process pool (staged pipeline)")
+    ap.add_argument("--queue_size", type=int, default=16, help="Images in flight between pipeline stages")
+    ap.add_argument("-o", "--output",
+                    help="Write records here instead of stdout, format from the extension "
+                         "(.jsonl, .csv, .npz, .parquet, .arrow)")
+    ap.add_argument("--append", action="store_true", help="Append to an existing .jsonl/.csv output")
+    ap.add_argument("--chunk_records", type=int, default=1024,
+                    help="Records per columnar chunk (.npz, .parquet, .arrow)")
+    ap.add_argument("--cache", help="SQLite file caching results between runs")
+    ap.add_argument("--cache_size", type=int, default=256, help="Cache size limit in MB")
+    ap.add_argument("--timings", action="store_true", help="Add per stage timings to each record")
+    ap.add_argument("--memory", action="store_true", help="With --timings, also trace peak allocations")
+    ap.add_argument("--prometheus", help="With --timings, write stage totals here (Prometheus text)")
+    ap.add_argument("--profile", action="store_true", help="Profile the first image with cProfile")
+    args = ap.parse_args(argv)
+
+    sizes = None
+    if args.table or args.payload_size:
+        if not args.qr:
+            ap.error("--table and --payload_size require --qr")
+        sizes = reference_table.load_sizes(args.table, args.payload_size)
+    if args.qr:
+        if args.qr_size is None and sizes is None:
+            ap.error("--qr requires --qr_size (or --table / --payload_size)")
+        if args.qr_size is not None:
+            args.real_width = args.real_height = args.qr_size
+    elif args.real_width is None or args.real_height is None:
+        ap.error("--real_width and --real_height are required without --qr")
+
+    paths = list_images(args.images)
+    if not paths:
+        print("No images found: %s" % args.images, file=sys.stderr)
+        return 1
+
+    options = {'real_width': args.real_width, 'real_height': args.real_height,
+               'scale': args.scale, 'max_side': args.max_side, 'ref_pixels': args.ref_pixels,
+               'refine': args.refine, 'qr': args.qr, 'target': args.target,
+               'table': args.table, 'payload_size': args.payload_size,
+               'auto': args.auto, 'min_confidence': args.min_confidence, 'robust': args.robust,
+               'cache': args.cache, 'cache_bytes': args.cache_size * 1024 * 1024,
+               'timings': args.timings or bool(args.prometheus), 'memory': args.memory}
+
+    if args.profile:
+        record = instrument.profile(measure_one, (paths[0], options))
+        print(json.dumps(record))
+        return 0 if record['status'] == 'ok' else 2
+
+    out = results.open_writer(args.output, args.chunk_records, args.append, sys.stdout)
+    failed = 0
+    timings = []
+    try:
+        if args.io_threads > 0:
+            # imported here, pipeline imports this module
+            import pipeline
+            records = pipeline.run(paths, options, args.io_threads, args.workers, args.queue_size)
+        else:
+            records = run(paths, options, args.workers, args.chunksize)
+        for record in records:
+            if record['status'] != 'ok':
+                failed += 1
+            if 'timings' in record:
+                timings.append({'image': record['image'], 'stages': record['timings']})
+            out.write(record)
+    finally:
+        out.close()
+
+    if args.prometheus:
+        with open(args.prometheus, 'w') as f:
+            f.write(instrument.prometheus_text(timings))
+
+    print("%d images, %d failed" % (len(paths), failed), file=sys.stderr)
+    return 0 if failed == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+'''
+Synthetic Benchmark
+==================
+
+Generates synthetic photos of books with known dimensions: a textured book cover
+with a printed QR code of known size, under random perspective, scale and noise.
+The measurement pipeline (measure.read_inputs + measure_inputs) is run over all
+of them with instrument enabled, reporting the latency percentiles of each stage
+it records, images per second and the error of the measured edges against the
+ground truth.
+
+By default the reference corners come from the sidecar (ground truth, optionally
+perturbed with --corner_noise), so only decode + homography + measure are timed.
+With --qr the QR code is detected in the image, as in measure.py --qr.
+
+With --startup, the import time of the command line entry points is measured
+instead, each in a fresh interpreter, and any optional module (pyzbar, pyarrow,
+matplotlib, the GUI/tracker samples, ...) loaded at import time is reported.
+With --max_startup the run fails when an import takes longer or loads one of
+them, to catch startup regressions.
+
+Usage
+-----
+benchmark.py [--count 200] [--seed 0] [--qr] [--refine] [--corner_noise <pixels>]
+             [--scale 0.25] [--keep <directory>] [--json]
+benchmark.py --startup [--repeat 5] [--max_startup <ms>] [--json]
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+import geometry
+import instrument
+import measure
+
+# pixels per cm of the flat book cover before it is put in perspective
+PX_PER_CM = 40.0
+QR_SIZE_CM = 4.0
+
+def qr_code(payload, side):
+    '''
+    QR code image of about side pixels, and the corners of the symbol
+    (without quiet zone) in its coordinates.
+    '''
+    modules = cv2.QRCodeEncoder.create().encode(payload)
+    ys, xs = np.where(modules == 0)
+    module_px = max(1, int(round(float(side) / (xs.max() - xs.min() + 1))))
+    image = cv2.resize(modules, (0, 0), fx=module_px, fy=module_px, interpolation=cv2.INTER_NEAREST)
+    x0, y0 = xs.min() * module_px, ys.min() * module_px
+    x1, y1 = (xs.max() + 1) * module_px, (ys.max() + 1) * module_px
+    corners = np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=float)
+    return image, corners, (x1 - x0) / PX_PER_CM
+
+def book_cover(rng, width_cm, height_cm):
+    '''
+    Textured flat book cover, with a QR code printed on it. Returns the cover
+    image, the QR symbol corners on it and the real side of the QR code in cm.
+    '''
+    w, h = int(round(width_cm * PX_PER_CM)), int(round(height_cm * PX_PER_CM))
+    # low frequency colour blobs plus some fine grain
+    blobs = rng.integers(40, 220, size=(6, 4, 3)).astype(np.uint8)
+    cover = cv2.resize(blobs, (w, h), interpolation=cv2.INTER_CUBIC)
+    cover = cv2.add(cover, rng.integers(0, 20, size=cover.shape).astype(np.uint8))
+
+    qr, corners, qr_cm = qr_code('REF-%dcm' % QR_SIZE_CM, QR_SIZE_CM * PX_PER_CM)
+    x = int(rng.integers(int(0.05 * w), max(int(0.05 * w) + 1, w - qr.shape[1] - int(0.05 * w))))
+    y = int(rng.integers(int(0.05 * h), max(int(0.05 * h) + 1, h - qr.shape[0] - int(0.05 * h))))
+    cover[y:y + qr.shape[0], x:x + qr.shape[1]] = qr[..., None]
+    return cover, corners + [x, y], qr_cm
+
+def scene(rng, image_size=(1600, 1200)):
+    '''
+    One synthetic photo: (image, book corners, reference corners, truth) where
+    truth holds the real book width and height and the real QR side, in cm.
+    '''
+    width_cm = rng.uniform(12, 22)
+    height_cm = rng.uniform(18, 30)
+    cover, qr_corners, qr_cm = book_cover(rng, width_cm, height_cm)
+    ch, cw = cover.shape[:2]
+
+    # random scale, position and perspective of the book in the photo
+    W, H = image_size
+    fit = min(W / float(cw), H / float(ch)) * rng.uniform(0.5, 0.85)
+    center = np.array([W, H]) / 2.0 + rng.uniform(-0.1, 0.1, 2) * [W, H]
+    rect = (geometry.rectangle((cw + 1, ch + 1)) - [cw / 2.0, ch / 2.0]) * fit + center
+    jitter = rng.uniform(-0.08, 0.08, (4, 2)) * [cw * fit, ch * fit]
+    book = rect + jitter
+
+    Hm = cv2.getPerspectiveTransform(geometry.rectangle((cw + 1, ch + 1)).astype(np.float32),
+                                     book.astype(np.float32))
+    background = np.full((H, W, 3), rng.integers(60, 200, 3), dtype=np.uint8)
+    image = cv2.warpPerspective(cover, Hm, (W, H), dst=background, borderMode=cv2.BORDER_TRANSPARENT)
+
+    sigma = rng.uniform(0, 6)
+    noise = rng.normal(0, sigma, image.shape)
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+    reference = geometry.project(Hm[None], qr_corners[None])[0]
+    truth = {'width': cw / PX_PER_CM, 'height': ch / PX_PER_CM, 'reference': qr_cm}
+    return image, book, reference, truth
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float) * 1000.0
+    if len(values) == 0:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'mean_ms': values.mean()}
+
+def run(count, seed=0, qr=False, refine=False, corner_noise=0.0, scale=0.25, keep=None):
+    '''
+    Generate count scenes, measure them all and return the report dict.
+    '''
+    rng = np.random.default_rng(seed)
+    directory = keep or tempfile.mkdtemp(prefix='book_benchmark_')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    stages = {'total': []}
+    errors = {'width': [], 'height': []}
+    failed = 0
+    instrument.enable()
+    try:
+        jobs = []
+        for i in range(count):
+            image, book, reference, truth = scene(rng)
+            path = os.path.join(directory, 'scene_%04d.jpg' % i)
+            cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 92])
+            book = book + rng.normal(0, corner_noise, book.shape) if corner_noise else book
+            reference = reference + rng.normal(0, corner_noise, reference.shape) if corner_noise else reference
+            with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+                json.dump({'book': book.tolist(), 'reference': reference.tolist()}, f)
+            jobs.append((path, truth))
+
+        start_all = time.perf_counter()
+        for path, truth in jobs:
+            real = truth['reference']
+            instrument.begin(path)
+            try:
+                t0 = time.perf_counter()
+                inputs = measure.read_inputs(path, os.path.splitext(path)[0] + '.json', scale,
+                                             qr=qr, refine=refine)
+                result, warped = measure.measure_inputs(inputs, real, real, qr=qr)
+                total = time.perf_counter() - t0
+            except (IOError, ValueError):
+                failed += 1
+                continue
+            finally:
+                record = instrument.end()
+            for name, timing in record['stages'].items():
+                stages.setdefault(name, []).append(timing['wall'])
+            stages['total'].append(total)
+            for key in ('top', 'bottom'):
+                errors['width'].append(result[key] - truth['width'])
+            for key in ('left', 'right'):
+                errors['height'].append(result[key] - truth['height'])
+        elapsed = time.perf_counter() - start_all
+    finally:
+        instrument.disable()
+        if keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'images': count,
+        'failed': failed,
+        'images_per_sec': (count - failed) / elapsed if elapsed > 0 else 0.0,
+        'stages': dict((name, percentiles(times)) for name, times in stages.items()),
+    }
+    for name, err in errors.items():
+        err = np.abs(err)
+        if len(err):
+            report['error_' + name] = {'mean_cm': err.mean(), 'p90_cm': np.percentile(err, 90),
+                                       'max_cm': err.max()}
+    return report
+
+# entry points timed by --startup
+STARTUP_MODULES = ('measure', 'batch', 'pipeline', 'server', 'stream', 'rig')
+# loaded on first use only, never at import time
+LAZY_MODULES = ('pyzbar', 'pyarrow', 'matplotlib', 'sqlite3', 'cProfile', 'tkinter',
+                'video', 'common', 'plane_tracker', 'qr_code_detection', 'cover_detection',
+                'feature_store')
+
+_STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules) & set(sys.argv[1:]))))
+'''
+
+def startup(modules=STARTUP_MODULES, repeat=5):
+    '''
+    Import time of each module in a fresh interpreter (median of repeat runs),
+    the whole process time, and the lazy modules it loaded.
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = {}
+    for module in modules:
+        imports, processes, loaded = [], [], set()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = subprocess.check_output([sys.executable, '-c', _STARTUP_SCRIPT % module] +
+                                          list(LAZY_MODULES), cwd=here, universal_newlines=True)
+            processes.append(time.perf_counter() - start)
+            lines = out.splitlines()
+            imports.append(float(lines[0]))
+            loaded.update(lines[1].split() if len(lines) > 1 else [])
+        report[module] = {'import_ms': float(np.median(imports)) * 1000,
+                          'process_ms': float(np.median(processes)) * 1000,
+                          'lazy_loaded': sorted(loaded)}
+    return report
+
+def print_startup(report):
+    for module, r in report.items():
+        print("%-10s import %8.1f ms  process %8.1f ms%s" % (
+            module, r['import_ms'], r['process_ms'],
+            "  loads " + ", ".join(r['lazy_loaded']) if r['lazy_loaded'] else ""))
+
+def print_report(report):
+    print("Images: %d, failed: %d, %.1f images/sec" % (report['images'], report['failed'],
+                                                         report['images_per_sec']))
+    names = sorted(name for name in report['stages'] if name != 'total') + ['total']
+    for name in names:
+        p = report['stages'].get(name)
+        if p:
+            print("%-10s p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms" % (name, p['p50_ms'], p['p90_ms'], p['p99_ms']))
+    for name in ('width', 'height'):
+        e = report.get('error_' + name)
+        if e:
+            print("%-6s error: mean %.3f cm, p90 %.3f cm, max %.3f cm" % (name, e['mean_cm'], e['p90_cm'], e['max_cm']))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Synthetic speed and accuracy benchmark")
+    ap.add_argument("-n", "--count", type=int, default=200, help="Number of synthetic images")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed")
+    ap.add_argument("--qr", action="store_true", help="Detect the QR reference instead of using the sidecar")
+    ap.add_argument("-r", "--refine", action="store_true", help="Refine corners at full resolution")
+    ap.add_argument("--corner_noise", type=float, default=0.0, help="Sidecar corner noise (pixels)")
+    ap.add_argument("-s", "--scale", type=float, default=0.25, help="Working resolution scale")
+    ap.add_argument("--keep", help="Keep the generated images in this directory")
+    ap.add_argument("--json", action="store_true", help="Print the report as JSON")
+    ap.add_argument("--startup", action="store_true", help="Measure import time of the entry points instead")
+    ap.add_argument("--repeat", type=int, default=5, help="With --startup, runs per module")
+    ap.add_argument("--max_startup", type=float,
+                    help="With --startup, fail if an import takes longer (ms) or loads a lazy module")
+    args = ap.parse_args(argv)
+
+    if args.startup:
+        report = startup(repeat=args.repeat)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_startup(report)
+        if args.max_startup is not None:
+            slow = [m for m, r in report.items() if r['import_ms'] > args.max_startup or r['lazy_loaded']]
+            if slow:
+                print("Startup regression: %s" % ", ".join(slow), file=sys.stderr)
+                return 1
+        return 0
+
+    report = run(args.count, args.seed, args.qr, args.refine, args.corner_noise, args.scale, args.keep)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
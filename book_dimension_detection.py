@@ -30,28 +30,40 @@ import numpy as np
 import cv2 as cv
 
 # local modules
-import video
-from video import presets
-import common
-from common import getsize, draw_keypoints
-from plane_tracker import PlaneTracker
+from utils import load_image
+from feature_store import share_frame_features
+import buffers
+import instrument
 
 class App:
-    def __init__(self, src):
-        image = cv.imread(src, 1)
-        small = cv.resize(image, (0,0), fx=0.125, fy=0.125) # resizing the image, as high resolution image taken
-        self.frame = small
+    def __init__(self, frame):
+        # GUI and tracking helpers (OpenCV samples), only loaded with a window
+        import common
+        from plane_tracker import PlaneTracker
+
+        # the frame is loaded once and shared by all the App instances, and
+        # so are its features
+        self.frame = frame
         self.paused = False
-        self.tracker = PlaneTracker()
+        self.tracker = share_frame_features(PlaneTracker())
 
         cv.namedWindow('Selected Region')
         self.rect_sel = common.RectSelector('Selected Region', self.on_rect)
 
+    def vis_buffer(self, w, h):
+        '''
+        Side by side display buffer, allocated once and cleared every frame.
+        '''
+        vis = buffers.get('vis', (h, w*2, 3))
+        vis.fill(0)
+        return vis
+
     def on_rect(self, rect):
         self.tracker.clear()
         self.tracker.add_target(self.frame, rect)
 
     def run_original(self):
+        from common import getsize, draw_keypoints
         while True:
             playing = not self.paused and not self.rect_sel.dragging
             # flag used to quit imaging, when the size detected.
@@ -63,7 +75,7 @@ class App:
             #     self.frame = frame.copy()
             # size of the frame (image) - used to draw rectangle
             w, h = getsize(self.frame)
-            vis = np.zeros((h, w*2, 3), np.uint8)
+            vis = self.vis_buffer(w, h)
             # copy to the image (original)
             vis[:h,:w] = self.frame
             if len(self.tracker.targets) > 0:
@@ -87,6 +99,7 @@ class App:
         Runs the program, of selection of the image's region. Approximates the
         dimensions of the cover based on given dimensions.
         '''
+        from common import getsize, draw_keypoints
         while True:
             # flag used to quit imaging, when the size detected.
             flag = 0
@@ -94,7 +107,7 @@ class App:
 
             # get size of the book cover
             w, h = getsize(self.frame)
-            vis = np.zeros((h, w*2, 3), np.uint8)
+            vis = self.vis_buffer(w, h)
             vis[:h,:w] = self.frame
 
             if len(self.tracker.targets) > 0:
@@ -122,7 +135,8 @@ class App:
 
             # Optional (useful in case of video source)
             if playing:
-                tracked = self.tracker.track(self.frame)
+                with instrument.stage('orb_track'):
+                    tracked = self.tracker.track(self.frame)
                 if len(tracked) > 0:
                     tracked = tracked[0]
                     cv.polylines(vis, [np.int32(tracked.quad)], True, (255, 255, 255), 2)
@@ -149,6 +163,7 @@ if __name__ == '__main__':
         img_src = sys.argv[1]
     except:
         img_src = "book_new.jpg"
-    Dimensions_cover = App(img_src).run_original()
+    small = load_image(img_src, 0.125) # decoded at reduced size, as high resolution image taken
+    Dimensions_cover = App(small).run_original()
     # print(Dimensions_cover, [14, 1.1])
-    App(img_src).run(Dimensions_cover, [14, 1.1])
+    App(small).run(Dimensions_cover, [14, 1.1])
@@ -16,12 +16,14 @@ Instructions
                     top left -> top right -> bottom right -> bottom left
   3) If the program quits, then it means that you haven't selected all 8 points.
   4) The program will then show real width and height of all the edges.
+  With --auto the book cover corners are detected, and only the 4 corners of the
+  relative shape are selected (unless the detection is unsure).
 
 [Note: Here, text has to be "AMBIGUITIES", if not then update the actual lengths in main method.]
 
 Usage
 -----
-book_length_detection.py --image [<image source>] --real_width [<real_width>] --real_height [<real_height>]
+book_length_detection.py --image [<image source>] --real_width [<real_width>] --real_height [<real_height>] [--auto]
 
 real_height and real_weight : of the relative shape [for test, 1.1 and 14 respectively of "AMBIGUITIES"]
 
@@ -34,6 +36,7 @@ import argparse
 import sys
 import cv2 as cv
 import math
+from utils import load_image
 
 def distance(x0,y0,x1,y1):
     sq1 = (x0 - x1)**2
@@ -63,6 +66,7 @@ if __name__ == '__main__':
     ap.add_argument("-i", "--image", required=True, help="Path to image")
     ap.add_argument("-w", "--real_width", required = True, help = "Real Width")
     ap.add_argument("-H", "--real_height", required = True, help = "Real Height")
+    ap.add_argument("-a", "--auto", action="store_true", help="Detect the book corners")
 
     try:
         args = vars(ap.parse_args())
@@ -70,13 +74,21 @@ if __name__ == '__main__':
         real_width = args["real_width"]
         real_height = args["real_height"]
 
-        image = cv2.imread(args["image"])
+        # resizing, reducing higher resolution (done while decoding)
+        clone = load_image(args["image"], 0.125)
+        if clone is None:
+            raise IOError("Could not read image")
     except:
         print("Check if proper arguments are given.")
         print("Quitting")
         sys.exit()
 
-    clone = cv.resize(image, (0,0), fx=0.125, fy=0.125) # resizing, reducing higher resolution
+    if args["auto"]:
+        from cover_detection import detect_cover
+        quad, confidence = detect_cover(clone)
+        print("Detected book corners, confidence %.2f" % confidence)
+        if quad is not None and confidence >= 0.5:
+            refPt.extend((int(round(x)), int(round(y))) for x, y in quad)
 
     cv.namedWindow("image")
     # set mouse call back event for left button double click
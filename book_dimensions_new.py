@@ -13,16 +13,22 @@ Instructions
   1) Select corner points of the book cover. Click on the points, starting in this order:
                     top left -> top right -> bottom right -> bottom left
   2) Corrected image will be shown in front of you (perspective correction).
+     It is saved only with --warped <path>. With --no_warp nothing is warped, the
+     relative shape is selected on the original image instead and its corners
+     are projected through the homography.
   3) Select corner points of the relative shape. (test case - "AMBIGUITIES") in this order:
                     top left -> top right -> bottom right -> bottom left
   4) If the program quits, then it means that you haven't selected all 8 points.
   5) The program will then show real width and height of all the edges.
+  With --auto the book cover corners are detected, step 1) is only needed when
+  the detection is unsure.
 
 [Note: Here, text has to be "AMBIGUITIES", if not then update the actual lengths in main method.]
 
 Usage
 -----
-book_dimensions_new.py --image [<image source>] --real_width [<real_width>] --real_height [<real_height>]
+book_dimensions_new.py --image [<image source>] --real_width [<real_width>] --real_height [<real_height>] [--auto]
+                       [--warped images/book_perspective.jpg | --no_warp]
 
 real_height and real_weight : of the relative shape [for test, 1.1 and 14 respectively of "AMBIGUITIES"]
 
@@ -48,6 +54,10 @@ if __name__ == '__main__':
     ap.add_argument("-i", "--image", required=True, help="Path to image")
     ap.add_argument("-w", "--real_width", required = True, help = "Real Width")
     ap.add_argument("-H", "--real_height", required = True, help = "Real Height")
+    ap.add_argument("-a", "--auto", action="store_true", help="Detect the book corners")
+    ap.add_argument("--warped", help="Save the perspective corrected image to this path")
+    ap.add_argument("--no_warp", action="store_true",
+                    help="Select the relative shape on the original image, nothing is warped")
 
     try:
         args = vars(ap.parse_args())
@@ -55,22 +65,19 @@ if __name__ == '__main__':
         real_width = args["real_width"]
         real_height = args["real_height"]
 
-        img = cv2.imread(args["image"])
+        # Optional
+        # resizing, reducing higher resolution (done while decoding)
+        clone = load_image(args["image"], 0.125)
+        if clone is None:
+            raise IOError("Could not read image")
 
     except:
         print("Check if proper arguments are given.")
         print("Quitting")
         sys.exit()
 
-    # Optional
-    # resizing, reducing higher resolution
-    clone = cv2.resize(img, (0,0), fx=0.125, fy=0.125) 
-
     size = (300, 400, 3)
 
-    # create numpy array (zero matrix) with given size
-    img_dest = np.zeros(size, np.uint8)
-
     # reference points for destination image
     refPt_dst = np.array(
                        [
@@ -84,8 +91,16 @@ if __name__ == '__main__':
     cv2.imshow("Image", clone)
 
     # get points of the corner of the books
-    print('Select points of the corner of the books. (top left to bottom right). Once done, press any key')
-    points = get_four_points(clone)
+    points = None
+    if args["auto"]:
+        from cover_detection import detect_cover
+        quad, confidence = detect_cover(clone)
+        print("Detected book corners, confidence %.2f" % confidence)
+        if quad is not None and confidence >= 0.5:
+            points = quad.astype(float)
+    if points is None:
+        print('Select points of the corner of the books. (top left to bottom right). Once done, press any key')
+        points = get_four_points(clone)
 
     if(len(points) != 4):
         print("You are required to enter only 4 points.")
@@ -95,23 +110,29 @@ if __name__ == '__main__':
     # Calculation of Homography matrix
     h, status = cv2.findHomography(points, refPt_dst)
 
-    # Warping source image to destination image
-    img_dest = cv2.warpPerspective(clone, h, size[0:2])
-
-    # Save the corrected image for future reference
-    cv2.imwrite("images/book_perspective.jpg", img_dest)
-
     # set corner of the books to the corner of the image
-    refPt = [[0, 0], [img_dest.shape[1], 0], [img_dest.shape[1], img_dest.shape[0]], [0, img_dest.shape[0]]]
+    refPt = [[0, 0], [size[0], 0], [size[0], size[1]], [0, size[1]]]
     # refPt = get_four_points(img_dest) # book corners selected earlier
     # get reference image corners
     print('Select corners of the reference image. (top left to bottom left). Once done, press any key')
-    refPt_reference = get_four_points(img_dest)
+    if args["no_warp"]:
+        # geometry only, the corners are mapped instead of the pixels
+        refPt_reference = get_four_points(clone)
+    else:
+        # Warping source image to destination image
+        img_dest = cv2.warpPerspective(clone, h, size[0:2])
+
+        # Save the corrected image for future reference
+        if args["warped"]:
+            cv2.imwrite(args["warped"], img_dest)
+        refPt_reference = get_four_points(img_dest)
 
     if(len(refPt_reference) != 4):
         print("You are required to enter only 4 points.")
         print("Quitting.")
         sys.exit()
+    if args["no_warp"]:
+        refPt_reference = cv2.perspectiveTransform(refPt_reference.reshape(-1, 1, 2), h).reshape(4, 2)
     # print(refPt)
     # calculate edge lengths based on recorded points
     Dimensions_width_top = distance(refPt[0], refPt[1])
@@ -0,0 +1,38 @@
+'''
+Reusable scratch and output buffers.
+
+Warping, remapping and drawing write whole frames, and allocating a new one
+for every image is a measurable part of the per image time. Buffers are kept
+per thread (so per worker, in a process pool or a thread pool) and handed out
+again when the same name, shape and type are asked for:
+
+    warped = cv2.warpPerspective(image, H, size, dst=buffers.get('warp', (h, w, 3)))
+
+A buffer is overwritten by the next call asking for it; copy what must outlive
+that call.
+'''
+import threading
+
+import numpy as np
+
+_local = threading.local()
+
+def get(name, shape, dtype=np.uint8):
+    '''
+    Buffer of the given shape and type for this thread, reused between calls.
+    Its contents are whatever the last user left in it.
+    '''
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = _local.pool = {}
+    shape = tuple(int(n) for n in shape)
+    buf = pool.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = pool[name] = np.empty(shape, dtype)
+    return buf
+
+def clear():
+    '''
+    Release this thread's buffers.
+    '''
+    _local.pool = {}
@@ -0,0 +1,117 @@
+'''
+Persistent result cache for the measurement pipeline.
+
+Results are stored in a SQLite file, keyed by the hash of the image file
+contents and the pipeline parameters (scale, destination size, real reference
+width and height, ...), so re-running a job over an unchanged archive only
+decodes images whose key changed. The stored value is the measurement result
+(reference/QR corners, homography and edge lengths).
+
+The cache is bounded in size: least recently used entries are evicted once
+the stored values exceed max_bytes.
+'''
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def file_hash(path, block_size=1 << 20):
+    '''
+    SHA-1 of the file contents.
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def cache_key(image_path, params):
+    '''
+    Key of an image under the given pipeline parameters (a JSON serialisable dict).
+    '''
+    return file_hash(image_path) + ':' + json.dumps(params, sort_keys=True)
+
+class ResultCache(object):
+    '''
+    Size bounded LRU cache of measurement results in a SQLite file.
+    Safe to open from several processes at once, and to share between threads.
+    '''
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        # running total of the stored sizes, kept by triggers so that every
+        # process sharing the file sees it without summing the whole table
+        self.db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        self.db.execute("INSERT OR IGNORE INTO stats "
+                        "SELECT 'bytes', COALESCE(SUM(size), 0) FROM results")
+        self.db.execute("CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN "
+                        "UPDATE stats SET value = value + NEW.size WHERE name = 'bytes'; END")
+        self.db.execute("CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size ON results BEGIN "
+                        "UPDATE stats SET value = value + NEW.size - OLD.size WHERE name = 'bytes'; END")
+        self.db.execute("CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN "
+                        "UPDATE stats SET value = value - OLD.size WHERE name = 'bytes'; END")
+        self.db.commit()
+
+    def get(self, key):
+        '''
+        Cached result for key, or None.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        '''
+        Store a result and evict old entries if the cache got too big.
+        '''
+        data = json.dumps(value)
+        with self.lock:
+            # an upsert, not INSERT OR REPLACE: replaced rows skip the delete trigger
+            self.db.execute('INSERT INTO results VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE '
+                            'SET value = excluded.value, size = excluded.size, '
+                            'last_used = excluded.last_used',
+                            (key, data, len(data), time.time()))
+            self.db.commit()
+            self._evict()
+
+    def total_bytes(self):
+        return self.db.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+
+    def evict(self):
+        '''
+        Drop least recently used entries until the cache fits in max_bytes.
+        '''
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        excess = self.total_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.db.execute('SELECT key, size FROM results ORDER BY last_used'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany('DELETE FROM results WHERE key = ?', keys)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
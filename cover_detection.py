@@ -0,0 +1,240 @@
+'''
+Automatic detection of book cover quads.
+
+Book covers are found as large convex four sided contours: edges (Canny) are
+closed with a small dilation, the outer contours are approximated by polygons
+and those with four corners and a reasonable area are kept. Corners are
+returned in the order used everywhere else:
+                    top left -> top right -> bottom right -> bottom left
+
+detect_cover picks the single book cover of a photo, replacing the manual
+corner clicks: every candidate quad is scored on how much of its outline lies
+on edges, how close its corners are to right angles, its size, whether it is
+cut by the image border and, when the reference (QR code) position is known,
+whether the reference is printed on it. A book often lies inside a larger
+outline that contains the reference just as well (a sheet, the table, the
+outline of the stack); of the candidates scoring close to the best one, the
+smallest containing the reference is taken. The confidence drops when a second
+candidate, other than such an enclosing outline, scores almost as well, so
+unsure images can go to manual review.
+'''
+import cv2
+import numpy as np
+
+import instrument
+from utils import order_points
+
+def edge_map(image, low=20, high=60):
+    '''
+    Closed edges of the image, used to find the cover outlines. Edges are
+    taken on every colour channel, a cover can have the same brightness as
+    the background but not the same colour.
+    '''
+    blurred = cv2.GaussianBlur(image, (5, 5), 0)
+    channels = cv2.split(blurred) if blurred.ndim == 3 else [blurred]
+    edges = np.zeros(blurred.shape[:2], np.uint8)
+    for channel in channels:
+        edges |= cv2.Canny(channel, low, high)
+    return cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+
+def find_quads(image, min_area=0.01, max_area=0.95, epsilon=0.02, edges=None):
+    '''
+    All convex four sided outlines in the image, largest first.
+    min_area and max_area are fractions of the image area.
+    Returns a list of (4, 2) corner arrays.
+    '''
+    h, w = image.shape[:2]
+    if edges is None:
+        edges = edge_map(image)
+    contours = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    quads = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if not (min_area * w * h <= area <= max_area * w * h):
+            continue
+        approx = approx_quad(contour, epsilon)
+        if approx is None:
+            continue
+        quads.append((area, order_points(approx)))
+
+    quads.sort(key=lambda q: -q[0])
+    return suppress_duplicates([q for area, q in quads])
+
+def approx_quad(contour, epsilon=0.02):
+    '''
+    Four corners approximating the contour, or None. Outlines broken by
+    something lying on the cover (a label, a finger) are tried again on their
+    convex hull with a coarser tolerance.
+    '''
+    hull = cv2.convexHull(contour)
+    for points, eps in ((contour, epsilon), (hull, epsilon), (hull, 2 * epsilon)):
+        approx = cv2.approxPolyDP(points, eps * cv2.arcLength(points, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            return approx.reshape(4, 2)
+    return None
+
+def edge_support(edges, quad, samples=50):
+    '''
+    Fraction of points along the quad outline lying on (or next to) an edge.
+    '''
+    h, w = edges.shape[:2]
+    quad = np.float32(quad).reshape(4, 2)
+    t = np.linspace(0, 1, samples, endpoint=False)[:, None]
+    points = np.concatenate([quad[i] + t * (quad[(i + 1) % 4] - quad[i]) for i in range(4)])
+    xs = np.clip(np.round(points[:, 0]).astype(int), 0, w - 1)
+    ys = np.clip(np.round(points[:, 1]).astype(int), 0, h - 1)
+    return float(np.count_nonzero(edges[ys, xs])) / len(points)
+
+def corner_regularity(quad):
+    '''
+    1 for right angled corners, lower the more skewed the quad is.
+    '''
+    quad = np.float64(quad).reshape(4, 2)
+    a = np.roll(quad, -1, axis=0) - quad
+    b = np.roll(quad, 1, axis=0) - quad
+    cos = np.abs((a * b).sum(axis=1)) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-9)
+    return float(1.0 - cos.mean())
+
+def score_quad(quad, edges, reference=None, full_area=0.1, border=2):
+    '''
+    Score in [0, 1] of a candidate cover quad. full_area is the fraction of
+    the image from which size stops adding to the score.
+    '''
+    h, w = edges.shape[:2]
+    quad = np.float32(quad).reshape(4, 2)
+    score = edge_support(edges, quad) * corner_regularity(quad)
+    score *= min(1.0, np.sqrt(cv2.contourArea(quad) / (full_area * w * h)))
+    if (quad.min(axis=0) < border).any() or (quad[:, 0] > w - 1 - border).any() or \
+            (quad[:, 1] > h - 1 - border).any():
+        # probably cut off by the image border, the real corners are not seen
+        score *= 0.5
+    if reference is not None:
+        on_cover = contains(quad, np.mean(reference, axis=0)) and quad_iou(quad, reference) < 0.5
+        score *= 1.0 if on_cover else 0.4
+    return score
+
+def detect_cover(image, reference=None, min_area=0.05, tolerance=0.8):
+    '''
+    Corners of the book cover in the image and a confidence in [0, 1], or
+    (None, 0.0) if no candidate is found. reference (e.g. the QR code corners)
+    seeds the search: the smallest candidate it lies on, of those scoring at
+    least tolerance times the best score, is taken.
+    '''
+    with instrument.stage('detect_cover'):
+        edges = edge_map(image)
+        candidates = find_quads(image, min_area=min_area, edges=edges)
+        # thicker edges, so outlines a pixel off still count as supported
+        support = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+        scores = [score_quad(q, support, reference) for q in candidates]
+    if not candidates:
+        return None, 0.0
+    best = int(np.argmax(scores))
+    if reference is not None:
+        center = np.mean(reference, axis=0)
+        close = [i for i, score in enumerate(scores)
+                 if score >= tolerance * scores[best] and contains(candidates[i], center)]
+        if close:
+            best = min(close, key=lambda i: cv2.contourArea(np.float32(candidates[i])))
+    # outlines around the chosen cover do not make it less certain
+    others = [score for i, score in enumerate(scores)
+              if i != best and not encloses(candidates[i], candidates[best])]
+    runner_up = max(others) if others else 0.0
+    confidence = float(max(0.0, scores[best] - 0.5 * runner_up))
+    return candidates[best], confidence
+
+def quad_overlap(a, b):
+    '''
+    Intersection area of two convex quads over the area of the smaller one.
+    '''
+    a, b = np.float32(a), np.float32(b)
+    inter, _ = cv2.intersectConvexConvex(a, b)
+    smaller = min(cv2.contourArea(a), cv2.contourArea(b))
+    return inter / smaller if smaller > 0 else 0.0
+
+def encloses(outer, inner, overlap=0.95):
+    '''
+    True if inner lies (almost) entirely within the larger quad outer.
+    '''
+    return cv2.contourArea(np.float32(outer)) > cv2.contourArea(np.float32(inner)) and \
+        quad_overlap(inner, outer) >= overlap
+
+def quad_iou(a, b):
+    '''
+    Intersection over union of two convex quads.
+    '''
+    a, b = np.float32(a), np.float32(b)
+    inter, _ = cv2.intersectConvexConvex(a, b)
+    union = cv2.contourArea(a) + cv2.contourArea(b) - inter
+    return inter / union if union > 0 else 0.0
+
+def suppress_duplicates(quads, iou=0.8, area_ratio=0.8):
+    '''
+    Drop quads that are the same outline as one already kept (inner and outer
+    edge of the same cover): overlapping with an IoU above iou and of nearly
+    the same area. A quad lying inside a much larger one (a book on a sheet,
+    the table, the outline of a stack) is kept. quads are largest first.
+    '''
+    kept = []
+    for quad in quads:
+        area = cv2.contourArea(np.float32(quad))
+        if not any(quad_iou(quad, other) > iou and
+                   area >= area_ratio * cv2.contourArea(np.float32(other)) for other in kept):
+            kept.append(quad)
+    return kept
+
+def contains(quad, point):
+    return cv2.pointPolygonTest(np.float32(quad).reshape(-1, 1, 2), (float(point[0]), float(point[1])), False) >= 0
+
+def find_books(image, references=(), max_books=50, tolerance=0.8):
+    '''
+    Book cover quads in the image, skipping the reference shapes themselves
+    (e.g. QR codes, which are also four sided outlines). Candidates are
+    scored as in detect_cover. The cover each reference is printed on is
+    picked first, as detect_cover does, then the others by score; a candidate
+    enclosing a book already kept (a sheet, the table) or lying inside one (a
+    region of the cover art) is not a book.
+    '''
+    edges = edge_map(image)
+    candidates = [quad for quad in find_quads(image, edges=edges)
+                  if not any(quad_iou(quad, ref) > 0.5 for ref in references)]
+    # thicker edges, so outlines a pixel off still count as supported
+    support = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    scores = [score_quad(quad, support) for quad in candidates]
+
+    order = []
+    for ref in references:
+        center = np.mean(ref, axis=0)
+        inside = [i for i, quad in enumerate(candidates) if contains(quad, center)]
+        if inside:
+            best = max(scores[i] for i in inside)
+            close = [i for i in inside if scores[i] >= tolerance * best]
+            order.append(min(close, key=lambda i: cv2.contourArea(np.float32(candidates[i]))))
+    order += sorted(range(len(candidates)), key=lambda i: -scores[i])
+
+    books, kept = [], set()
+    for i in order:
+        quad = candidates[i]
+        if i in kept or any(encloses(quad, book) or encloses(book, quad) for book in books):
+            continue
+        kept.add(i)
+        books.append(quad)
+        if len(books) == max_books:
+            break
+    return books
+
+def assign_references(books, references):
+    '''
+    Reference quad for each book: the one printed on it when there is one,
+    otherwise the first reference (shared scale for the whole photo).
+    Returns a list of (reference index, reference quad).
+    '''
+    assigned = []
+    for book in books:
+        index = 0
+        for i, ref in enumerate(references):
+            if contains(book, np.mean(ref, axis=0)):
+                index = i
+                break
+        assigned.append((index, references[index]))
+    return assigned
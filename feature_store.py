@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+'''
+Reference Target Feature Store
+==================
+
+ORB keypoints and descriptors of a reference target (the QR code, or the
+"AMBIGUITIES" text) are computed once, saved, and matched against every image
+with a FLANN-LSH index that is built once per process. This replaces extracting
+the target's features again for every image (PlaneTracker.add_target).
+
+The target corners are found in an image from the matches with a RANSAC
+homography, in the order top left -> top right -> bottom right -> bottom left,
+so they can be used as reference corners (measure.py --target).
+
+The interactive tracker scripts (book_dimension_*.py) still use the
+PlaneTracker of the OpenCV samples; share_frame_features makes all their
+trackers extract the features of the still frame they show only once.
+
+Usage
+-----
+feature_store.py --image [<target image>] --out [<target.npz>] [--rect x0 y0 x1 y1] [--scale 1.0]
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import sys
+import cv2
+import numpy as np
+
+import instrument
+from utils import load_image
+
+FLANN_INDEX_LSH = 6
+flann_params = dict(algorithm=FLANN_INDEX_LSH,
+                    table_number=6,
+                    key_size=12,
+                    multi_probe_level=1)
+
+# targets loaded in this process, by path
+_stores = {}
+
+# (frame, features) of the last frame a PlaneTracker extracted features of
+_frame_features = [None, None]
+
+class FeatureStore(object):
+    '''
+    Features of one reference target, with a lazily built matcher.
+    '''
+    def __init__(self, points, descriptors, quad):
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        self.descriptors = np.asarray(descriptors, dtype=np.uint8)
+        self.quad = np.asarray(quad, dtype=float).reshape(4, 2)
+        self.detector = cv2.ORB_create(nfeatures=1000)
+        self._matcher = None
+
+    @classmethod
+    def build(cls, image, rect=None, nfeatures=1000):
+        '''
+        Extract the features of the target inside rect = (x0, y0, x1, y1),
+        or of the whole image.
+        '''
+        h, w = image.shape[:2]
+        x0, y0, x1, y1 = rect if rect is not None else (0, 0, w, h)
+        mask = np.zeros((h, w), np.uint8)
+        mask[y0:y1, x0:x1] = 255
+        detector = cv2.ORB_create(nfeatures=nfeatures)
+        keypoints, descriptors = detector.detectAndCompute(image, mask)
+        if descriptors is None or len(keypoints) < 10:
+            raise ValueError("Not enough features on the target.")
+        points = [kp.pt for kp in keypoints]
+        quad = [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+        return cls(points, descriptors, quad)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a saved target, once per process.
+        '''
+        if path not in _stores:
+            data = np.load(path)
+            _stores[path] = cls(data['points'], data['descriptors'], data['quad'])
+        return _stores[path]
+
+    def save(self, path):
+        np.savez(path, points=self.points, descriptors=self.descriptors, quad=self.quad)
+
+    def matcher(self):
+        '''
+        FLANN-LSH index over the target descriptors, built on first use.
+        '''
+        if self._matcher is None:
+            self._matcher = cv2.FlannBasedMatcher(flann_params, {})
+            self._matcher.add([self.descriptors])
+            self._matcher.train()
+        return self._matcher
+
+    def matches(self, frame, min_matches=10, ratio=0.75):
+        '''
+        Matched (target points, frame points), outliers included, or None if
+        there are fewer than min_matches.
+        '''
+        with instrument.stage('orb_features'):
+            keypoints, descriptors = self.detector.detectAndCompute(frame, None)
+        if descriptors is None or len(keypoints) < min_matches:
+            return None
+
+        with instrument.stage('orb_match'):
+            matches = self.matcher().knnMatch(descriptors, k=2)
+        # Lowe's ratio test
+        good = [m[0] for m in matches if len(m) == 2 and m[0].distance < ratio * m[1].distance]
+        if len(good) < min_matches:
+            return None
+
+        p0 = self.points[[m.trainIdx for m in good]]
+        p1 = np.float32([keypoints[m.queryIdx].pt for m in good])
+        return p0, p1
+
+    def locate(self, frame, min_matches=10, ratio=0.75):
+        '''
+        Corners of the target in frame, or None if it is not found.
+        '''
+        matched = self.matches(frame, min_matches, ratio)
+        if matched is None:
+            return None
+        p0, p1 = matched
+        H, status = cv2.findHomography(p0, p1, cv2.RANSAC, 3.0)
+        if H is None or status.sum() < min_matches:
+            return None
+        return cv2.perspectiveTransform(self.quad.reshape(-1, 1, 2), H).reshape(4, 2)
+
+def share_frame_features(tracker):
+    '''
+    Make a plane_tracker.PlaneTracker reuse the features of the last frame
+    any tracker extracted. add_target and track both detect the features of
+    the whole frame; on a still image that is the same work on every call.
+    '''
+    detect = tracker.detect_features
+
+    def detect_features(frame):
+        if _frame_features[0] is not frame:
+            with instrument.stage('orb_features'):
+                _frame_features[:] = frame, detect(frame)
+        return _frame_features[1]
+    tracker.detect_features = detect_features
+    return tracker
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Extract and save reference target features")
+    ap.add_argument("-i", "--image", required=True, help="Image of the target")
+    ap.add_argument("-o", "--out", required=True, help="Output file (.npz)")
+    ap.add_argument("--rect", type=int, nargs=4, metavar=('X0', 'Y0', 'X1', 'Y1'),
+                    help="Target region in the image (default: whole image)")
+    ap.add_argument("-s", "--scale", type=float, default=1.0,
+                    help="Scale of the target image, same as the working scale of the photos")
+    args = ap.parse_args(argv)
+
+    image = load_image(args.image, args.scale)
+    if image is None:
+        print("Could not read image: %s" % args.image, file=sys.stderr)
+        return 1
+    try:
+        store = FeatureStore.build(image, args.rect)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    store.save(args.out)
+    print("%d features saved to %s" % (len(store.points), args.out), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
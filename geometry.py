@@ -0,0 +1,131 @@
+'''
+Vectorized measurement geometry, numpy only.
+
+All functions work on stacks of quads, shape (N, 4, 2), with corners in the
+order top left -> top right -> bottom right -> bottom left, so many books
+(per frame, or over a batch of frames) are measured in one call instead of
+one distance() at a time.
+'''
+import numpy as np
+
+# edges as (start corner, end corner), in the order top, bottom, left, right
+EDGES = np.array([[0, 1], [3, 2], [0, 3], [1, 2]])
+
+def as_quads(quads):
+    '''
+    Float array of shape (N, 4, 2) from a single quad or a stack of quads.
+    '''
+    quads = np.asarray(quads, dtype=float)
+    return quads.reshape(-1, 4, 2)
+
+def edge_lengths(quads):
+    '''
+    Edge lengths of each quad, shape (N, 4): top, bottom, left, right.
+    '''
+    quads = as_quads(quads)
+    return np.linalg.norm(quads[:, EDGES[:, 1]] - quads[:, EDGES[:, 0]], axis=2)
+
+def rectangle(size):
+    '''
+    Corner pixels of a size = (width, height) image, shape (4, 2).
+    '''
+    w, h = size
+    return np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]], dtype=float)
+
+def homographies(src, dst):
+    '''
+    Homographies mapping each src quad exactly onto its dst quad, shape (N, 3, 3).
+    dst may be a single quad shared by all. Degenerate quads give NaN matrices.
+    '''
+    src = as_quads(src)
+    dst = np.broadcast_to(as_quads(dst), src.shape)
+    n = len(src)
+
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+
+    # two rows per correspondence of the direct linear transform, h33 = 1
+    rows_u = np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=2)
+    rows_v = np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=2)
+    A = np.concatenate([rows_u, rows_v], axis=1)
+    b = np.concatenate([u, v], axis=1)
+
+    singular = np.abs(np.linalg.det(A)) < 1e-12
+    A[singular] = np.eye(8)
+    h = np.linalg.solve(A, b[..., None])[..., 0]
+    h[singular] = np.nan
+
+    return np.concatenate([h, np.ones((n, 1))], axis=1).reshape(n, 3, 3)
+
+def project(H, points):
+    '''
+    Apply homographies (N, 3, 3) to points (N, K, 2), returns (N, K, 2).
+    '''
+    points = np.asarray(points, dtype=float)
+    homogeneous = np.concatenate([points, np.ones(points.shape[:-1] + (1,))], axis=-1)
+    mapped = np.einsum('nij,nkj->nki', H, homogeneous)
+    return mapped[..., :2] / mapped[..., 2:]
+
+def real_lengths(book_edges, ref_edges, real_width, real_height):
+    '''
+    Real edge lengths, shape (N, 4), from the rectified edge lengths of the
+    books and their references, shape (N, 4) each: a book edge is as many
+    real widths (top, bottom) or heights (left, right) long as it is
+    reference edges. real_width and real_height are scalars or arrays of length N.
+    '''
+    real = np.stack(np.broadcast_arrays(np.asarray(real_width, dtype=float),
+                                        np.asarray(real_width, dtype=float),
+                                        np.asarray(real_height, dtype=float),
+                                        np.asarray(real_height, dtype=float)), axis=-1)
+    return np.asarray(book_edges, dtype=float) / np.asarray(ref_edges, dtype=float) * real
+
+def measure_quads(book_quads, ref_quads, real_width, real_height, size=(300, 400)):
+    '''
+    Measure N books at once. Each book quad is rectified onto a size rectangle,
+    its reference quad is mapped through the same homography and the ratio to
+    the real reference size gives the real edge lengths.
+
+    real_width and real_height may be scalars or arrays of length N.
+    Returns a dict of (N,) arrays: top, bottom, left, right, ratio_width,
+    ratio_height, the (N, 3, 3) homographies and the (N, 4) rectified edge
+    lengths book_edges and reference_edges (see real_lengths).
+    '''
+    book_quads = as_quads(book_quads)
+    H = homographies(book_quads, rectangle(size))
+    ref_rectified = project(H, as_quads(ref_quads))
+
+    book = np.broadcast_to(edge_lengths(rectangle(size)), (len(book_quads), 4))
+    ref = edge_lengths(ref_rectified)
+    lengths = real_lengths(book, ref, real_width, real_height)
+    # real length per rectified pixel of each edge
+    ratio = lengths / book
+
+    return {
+        'homography': H,
+        'book_edges': book,
+        'reference_edges': ref,
+        'top': lengths[:, 0],
+        'bottom': lengths[:, 1],
+        'left': lengths[:, 2],
+        'right': lengths[:, 3],
+        # real length per rectified pixel, averaged over both edges
+        'ratio_width': (ratio[:, 0] + ratio[:, 1]) / 2.0,
+        'ratio_height': (ratio[:, 2] + ratio[:, 3]) / 2.0,
+    }
+
+def fuse(values, sigmas):
+    '''
+    Inverse variance weighted mean of N estimates along the first axis, and
+    its standard deviation. When the estimates disagree more than their
+    sigmas allow, the deviation is scaled up by the observed spread.
+    '''
+    values = np.asarray(values, dtype=float)
+    variances = np.maximum(np.asarray(sigmas, dtype=float), 1e-9) ** 2
+    weights = 1.0 / variances
+    mean = (weights * values).sum(axis=0) / weights.sum(axis=0)
+    sigma = np.sqrt(1.0 / weights.sum(axis=0))
+    if len(values) > 1:
+        chi2 = (weights * (values - mean) ** 2).sum(axis=0) / (len(values) - 1)
+        sigma = sigma * np.sqrt(np.maximum(chi2, 1.0))
+    return mean, sigma
@@ -0,0 +1,172 @@
+'''
+Per stage timing instrumentation for the measurement pipeline.
+
+Pipeline code wraps each stage in
+
+    with instrument.stage('decode'):
+        ...
+
+which does nothing (one global lookup) unless instrumentation was enabled with
+enable(). When enabled, every stage of the current image records its wall time,
+CPU time and, with memory=True, its peak Python/numpy allocation (tracemalloc).
+
+    instrument.enable()
+    instrument.begin(path)
+    ... run the pipeline ...
+    record = instrument.end()   # {'image': path, 'stages': {name: {...}}}
+
+Records can be aggregated into Prometheus text, and profile()
+runs a single call under cProfile.
+'''
+from __future__ import print_function
+import sys
+import time
+import tracemalloc
+
+class _NullStage(object):
+    '''
+    Stage used while instrumentation is disabled.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        if self.recorder.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # resetting the peak below loses it for the stages still open, keep theirs
+            for outer in self.recorder.open:
+                outer.peak = max(outer.peak, peak - outer.mem_start)
+            self.recorder.open.append(self)
+            self.mem_start, self.peak = current, 0
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        timing = self.recorder.stages.setdefault(self.name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+        timing['wall'] += wall
+        timing['cpu'] += cpu
+        timing['calls'] += 1
+        if self.recorder.memory:
+            self.recorder.open.remove(self)
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self.mem_start)
+            timing['peak_bytes'] = max(timing.get('peak_bytes', 0), peak)
+        return False
+
+class Recorder(object):
+    '''
+    Collects stage timings of one image at a time.
+    '''
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.image = None
+        self.stages = {}
+        # stages being timed, outermost first
+        self.open = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def begin(self, image):
+        self.image = image
+        self.stages = {}
+
+    def end(self):
+        record = {'image': self.image, 'stages': self.stages}
+        self.image = None
+        self.stages = {}
+        return record
+
+_recorder = None
+
+def enable(memory=False):
+    '''
+    Turn instrumentation on for this process (idempotent).
+    '''
+    global _recorder
+    if _recorder is None or _recorder.memory != memory:
+        _recorder = Recorder(memory)
+    return _recorder
+
+def disable():
+    global _recorder
+    _recorder = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def enabled():
+    return _recorder is not None
+
+def stage(name):
+    '''
+    Context manager timing one pipeline stage.
+    '''
+    if _recorder is None:
+        return _NULL_STAGE
+    return _Stage(_recorder, name)
+
+def begin(image):
+    if _recorder is not None:
+        _recorder.begin(image)
+
+def end():
+    '''
+    Record of the current image, or None when disabled.
+    '''
+    if _recorder is None:
+        return None
+    return _recorder.end()
+
+def prometheus_text(records, prefix='book_measure'):
+    '''
+    Aggregate records into Prometheus text exposition format.
+    '''
+    totals = {}
+    for record in records:
+        for name, timing in record['stages'].items():
+            total = totals.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'count': 0, 'peak_bytes': 0})
+            total['wall'] += timing['wall']
+            total['cpu'] += timing.get('cpu', 0.0)
+            total['count'] += 1
+            total['peak_bytes'] = max(total['peak_bytes'], timing.get('peak_bytes', 0))
+
+    lines = ['# TYPE %s_stage_seconds summary' % prefix]
+    for name in sorted(totals):
+        lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (prefix, name, totals[name]['wall']))
+        lines.append('%s_stage_seconds_count{stage="%s"} %d' % (prefix, name, totals[name]['count']))
+    lines.append('# TYPE %s_stage_cpu_seconds_total counter' % prefix)
+    for name in sorted(totals):
+        lines.append('%s_stage_cpu_seconds_total{stage="%s"} %f' % (prefix, name, totals[name]['cpu']))
+    lines.append('# TYPE %s_stage_peak_bytes gauge' % prefix)
+    for name in sorted(totals):
+        lines.append('%s_stage_peak_bytes{stage="%s"} %d' % (prefix, name, totals[name]['peak_bytes']))
+    return '\n'.join(lines) + '\n'
+
+def profile(func, *args, **kwargs):
+    '''
+    Run func under cProfile, print the top functions by cumulative time to
+    stderr and return its result.
+    '''
+    # only needed with --profile
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(25)
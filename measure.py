@@ -0,0 +1,662 @@
+#!/usr/bin/env python
+
+'''
+Headless Book Dimension Measurement
+==================
+
+Same pipeline as book_dimensions_new.py (Homography -> ratio), without any GUI
+calls, so it can run on servers and in batch jobs. Only the corners are
+projected through the homography; the image itself is warped only when the
+perspective corrected image is asked for (--warped).
+
+Instead of mouse clicks, the corner points are read from a sidecar file:
+
+JSON : {"book": [[x, y], ...], "reference": [[x, y], ...]}
+CSV  : one corner per row, "quad,x,y" where quad is "book" or "reference"
+
+Both quads are given in the order the other scripts expect:
+                    top left -> top right -> bottom right -> bottom left
+and in the pixel coordinates of the original (full resolution) image.
+
+With --qr the reference corners are not needed: the printed QR code is found
+with zbar and used as reference shape, with side length --qr_size.
+
+Usage
+-----
+measure.py --image [<image source>] --real_width [<real_width>] --real_height [<real_height>]
+           [--quads <sidecar .json/.csv>] [--scale 0.125 | --max_side <pixels>] [--ref_pixels <pixels>] [--refine]
+           [--warped <output image>] [--robust] [--timings [--memory]] [--profile]
+measure.py --image [<image source>] --qr --qr_size [<qr_size>] [--quads <sidecar .json/.csv>]
+measure.py --image [<image source>] --auto (--qr --qr_size [<qr_size>] | --quads <sidecar>) [--min_confidence 0.5]
+measure.py --image [<image source>] --multi (--qr --qr_size [<qr_size>] | --real_width .. --real_height ..)
+
+If --quads is not given, <image source> with a .json (then .csv) extension is used.
+With --max_side the scale is picked per image so that its longer side is at most
+that many pixels. Downscaling is done while decoding (see utils.load_image).
+With --ref_pixels the scale is picked per image instead, as the smallest at
+which the reference is that many pixels across: a QR code or target is first
+searched for at --scale (or --max_side), and the scale is doubled only when it
+is not found. The chosen scale (and with --ref_pixels the scales tried) is in
+the output.
+
+With --target the reference is found by matching the saved ORB features of a
+reference target (see feature_store.py) instead of the sidecar corners.
+
+With --table (or --payload_size) the real size of the reference comes from the
+payload of its QR code, looked up in a table of reference IDs (or written in the
+payload, e.g. "REF-4cm"; see reference_table.py), so one run can handle
+reference codes of different sizes. --real_width/--real_height or --qr_size
+are then only the fallback for unknown payloads.
+
+With --multi every book cover in the photo is found automatically (see
+cover_detection.py) and measured in one pass. A QR code printed on a book is
+used as that book's reference, other books share the first reference found.
+Only the reference corners are read from the sidecar (none are needed with --qr).
+
+With --auto the book corners are not needed either: the cover is detected in
+the photo (see cover_detection.detect_cover), seeded by the reference position.
+The result then carries book_confidence, and review=true when it is below
+--min_confidence, for images that should be checked by hand.
+
+With --refine the corners found on the downscaled image are refined to sub-pixel
+accuracy on small windows of the full resolution image (cv2.cornerSubPix), and
+the homography is computed from the refined corners.
+
+With --robust the reference homography is fitted to every correspondence the
+references give (QR finder pattern corners, target feature matches) with
+USAC MAGSAC, instead of to four corners, and the estimates of all QR codes in
+the photo are fused (see robust.py). The result then carries width, height and
+their standard deviations width_std and height_std.
+
+Edge lengths are printed as one JSON object on stdout.
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import csv
+import json
+import os
+import sys
+import cv2
+import numpy as np
+import buffers
+import geometry
+import instrument
+import reference_table
+from utils import load_image, read_image, refine_corners, working_scale
+
+# size of the perspective corrected (destination) image: (width, height)
+DEST_SIZE = (300, 400)
+
+def dest_corners(size=DEST_SIZE):
+    '''
+    Corners of the destination image, top left -> top right -> bottom right -> bottom left.
+    '''
+    return geometry.rectangle(size)
+
+def load_quads(path, require_book=True):
+    '''
+    Read book and reference corners from a sidecar JSON or CSV file.
+    Returns (book_quad, reference_quad) as (4, 2) float arrays, reference_quad
+    (and book_quad, unless require_book) is None when the sidecar has no such
+    corners.
+    '''
+    quads = {'book': [], 'reference': []}
+    if path.lower().endswith('.csv'):
+        with open(path) as f:
+            for row in csv.reader(f):
+                if not row or row[0].strip() not in quads:
+                    # skip header and empty lines
+                    continue
+                quads[row[0].strip()].append([float(row[1]), float(row[2])])
+    else:
+        with open(path) as f:
+            data = json.load(f)
+        for key in quads:
+            quads[key] = data.get(key, [])
+
+    for key in quads:
+        if len(quads[key]) != 4 and (key == 'book' and require_book or quads[key]):
+            raise ValueError("%s: expected 4 %s corners, got %d" % (path, key, len(quads[key])))
+    book = np.array(quads['book'], dtype=float) if quads['book'] else None
+    reference = np.array(quads['reference'], dtype=float) if quads['reference'] else None
+    return book, reference
+
+def find_sidecar(image_path):
+    '''
+    Return the sidecar file next to the image (.json, then .csv), or None.
+    '''
+    root = os.path.splitext(image_path)[0]
+    for ext in ('.json', '.csv'):
+        if os.path.exists(root + ext):
+            return root + ext
+    return None
+
+def edge_lengths(quad):
+    '''
+    Lengths of the four edges of a quad: (top, bottom, left, right).
+    '''
+    top, bottom, left, right = geometry.edge_lengths(quad)[0]
+    return top, bottom, left, right
+
+def measure(image, book_quad, ref_quad, real_width, real_height, size=DEST_SIZE, warp=False):
+    '''
+    Perspective correct the book cover and approximate its edge lengths, using
+    the reference shape of known real width and height.
+
+    book_quad and ref_quad are (4, 2) corner arrays in image coordinates.
+    Returns (result, warped) where result holds both quads, the homography,
+    the four real edge lengths and the rectified pixel edge lengths of book and
+    reference they come from (see remeasure.py). warped is the perspective corrected image with
+    warp=True, in a reused buffer (see buffers.py) overwritten by the next
+    call, else None: the lengths only need the corners.
+    '''
+    book_quad = np.asarray(book_quad, dtype=float).reshape(4, 2)
+    ref_quad = np.asarray(ref_quad, dtype=float).reshape(4, 2)
+
+    # Calculation of Homography matrix
+    with instrument.stage('homography'):
+        h, status = cv2.findHomography(book_quad, dest_corners(size))
+    if h is None:
+        raise ValueError("Homography could not be computed from the book corners.")
+
+    # Warping source image to destination image, only for debugging output
+    warped = None
+    if warp:
+        with instrument.stage('warp'):
+            dst = buffers.get('warp', (size[1], size[0]) + image.shape[2:], image.dtype)
+            warped = cv2.warpPerspective(image, h, size, dst=dst)
+
+    # corners of the book are the corners of the destination image,
+    # reference corners are mapped through the same homography
+    refPt = dest_corners(size)
+    refPt_reference = cv2.perspectiveTransform(ref_quad.reshape(-1, 1, 2), h).reshape(4, 2)
+
+    book_top, book_bottom, book_left, book_right = edge_lengths(refPt)
+    ref_top, ref_bottom, ref_left, ref_right = edge_lengths(refPt_reference)
+    if min(ref_top, ref_bottom, ref_left, ref_right) < 1e-6:
+        raise ValueError("Degenerate reference corners.")
+
+    result = {
+        'book_quad': book_quad.tolist(),
+        'reference_quad': ref_quad.tolist(),
+        'homography': h.tolist(),
+        'book_edges': [float(v) for v in (book_top, book_bottom, book_left, book_right)],
+        'reference_edges': [float(v) for v in (ref_top, ref_bottom, ref_left, ref_right)],
+        'top': book_top / ref_top * float(real_width),
+        'bottom': book_bottom / ref_bottom * float(real_width),
+        'left': book_left / ref_left * float(real_height),
+        'right': book_right / ref_right * float(real_height),
+    }
+    return result, warped
+
+class ReferenceNotFound(ValueError):
+    '''
+    The reference shape is not in the image; retrying will not help.
+    '''
+
+def find_qr_reference(image, key=None, need_payload=False):
+    '''
+    Corners of the QR code in the image, ordered top left -> top right ->
+    bottom right -> bottom left. Raises ReferenceNotFound if no QR code is
+    found. key (e.g. the image path) lets failures be remembered.
+    With need_payload=True, returns (corners, payload).
+    '''
+    # only needed in QR mode
+    from qr_code_detection import locate
+
+    quad, payload = locate(image, need_payload=need_payload, key=key)
+    if quad is None:
+        raise ReferenceNotFound("No QR code found in the image.")
+    return (quad, payload) if need_payload else quad
+
+def read_payloads(image_path, image, quads, gray=None):
+    '''
+    Payloads of the QR codes at quads (working image coordinates), decoded on
+    the full resolution image: at working scale the modules are often too
+    small to decode. gray is the full resolution image if already loaded.
+    '''
+    from qr_code_detection import decode_roi
+
+    if gray is None:
+        with instrument.stage('decode_full'):
+            gray = read_image(image_path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise IOError("Could not read image: %s" % image_path)
+    scale_xy = np.array([float(image.shape[1]) / gray.shape[1],
+                         float(image.shape[0]) / gray.shape[0]])
+    return [decode_roi(gray, np.asarray(quad) / scale_xy) for quad in quads]
+
+def reference_size(payload, sizes, real_width, real_height):
+    '''
+    Real (width, height) of a reference: from its payload with the sizes
+    table, else the given fallback. Raises ValueError if neither is known.
+    '''
+    size = reference_table.lookup(payload, sizes)
+    if size is None:
+        if real_width is None or real_height is None:
+            raise ValueError("Unknown reference payload: %r" % (payload,))
+        size = (real_width, real_height)
+    return size
+
+def find_target_reference(image, target):
+    '''
+    Corners of the saved feature target (feature_store.py file) in the image.
+    Raises ValueError if it is not found.
+    '''
+    from feature_store import FeatureStore
+
+    quad = FeatureStore.load(target).locate(image)
+    if quad is None:
+        raise ReferenceNotFound("Reference target not found in the image.")
+    return quad
+
+def find_qr_references(image):
+    '''
+    (corners, payload) of all QR codes in the image. Raises ReferenceNotFound
+    if there are none.
+    '''
+    from qr_code_detection import find_references
+
+    references = find_references(image)
+    if not references:
+        raise ReferenceNotFound("No QR code found in the image.")
+    return references
+
+def measure_books(image, ref_quads, real_width, real_height, size=DEST_SIZE):
+    '''
+    Find all book covers in the image and measure them in one vectorized call.
+    Each book uses the reference printed on it if any, else the first one.
+    real_width and real_height are scalars, or one value per reference.
+    Returns a list of per book results.
+    '''
+    # only needed for multi book photos
+    import cover_detection
+
+    with instrument.stage('detect_books'):
+        books = cover_detection.find_books(image, ref_quads)
+    if not books:
+        raise ValueError("No book covers found in the image.")
+    assigned = cover_detection.assign_references(books, ref_quads)
+
+    index = [i for i, ref in assigned]
+    real_width = np.broadcast_to(np.asarray(real_width, dtype=float), (len(ref_quads),))[index]
+    real_height = np.broadcast_to(np.asarray(real_height, dtype=float), (len(ref_quads),))[index]
+    with instrument.stage('measure'):
+        m = geometry.measure_quads(np.array(books), np.array([ref for i, ref in assigned]),
+                                   real_width, real_height, size)
+    results = []
+    for i, book in enumerate(books):
+        results.append({
+            'book_quad': book.tolist(),
+            'reference': assigned[i][0],
+            'reference_quad': assigned[i][1].tolist(),
+            'book_edges': m['book_edges'][i].tolist(),
+            'reference_edges': m['reference_edges'][i].tolist(),
+            'top': float(m['top'][i]),
+            'bottom': float(m['bottom'][i]),
+            'left': float(m['left'][i]),
+            'right': float(m['right'][i]),
+        })
+    return results
+
+def locate_reference(image, qr=False, target=None):
+    '''
+    Corners of the QR code or saved target in the image, or None. Failures
+    are not remembered, the image may be tried again at a higher scale.
+    '''
+    if qr:
+        from qr_code_detection import locate
+
+        return locate(image)[0]
+    from feature_store import FeatureStore
+
+    return FeatureStore.load(target).locate(image)
+
+def adaptive_image(image_path, ref_pixels, scale=0.125, ref_quad=None, qr=False, target=None,
+                   max_scale=1.0):
+    '''
+    Decode the image at the smallest scale (up to max_scale) at which the
+    shortest reference edge is ref_pixels pixels long.
+
+    With sidecar reference corners (ref_quad, full resolution) the scale
+    follows from them directly. Otherwise the QR code or target is searched
+    for at scale first; the scale is only doubled when it is not found there.
+    Once found, the image is decoded again at the wanted scale if the
+    reference is too small, or resized down if it is larger than needed.
+    Returns (image, scale, scales tried, reference corners in the image or
+    None). Raises ReferenceNotFound if the reference is not found at max_scale.
+    '''
+    if ref_quad is not None and not qr and not target:
+        side = min(edge_lengths(ref_quad))
+        scale = min(max_scale, float(ref_pixels) / side) if side > 0 else max_scale
+        image = load_image(image_path, scale)
+        if image is None:
+            raise IOError("Could not read image: %s" % image_path)
+        return image, scale, [scale], None
+
+    tried = []
+    while True:
+        image = load_image(image_path, scale)
+        if image is None:
+            raise IOError("Could not read image: %s" % image_path)
+        tried.append(scale)
+        with instrument.stage('adaptive_locate'):
+            quad = locate_reference(image, qr, target)
+        if quad is not None:
+            break
+        if scale >= max_scale:
+            raise ReferenceNotFound("Reference not found, even at scale %g." % scale)
+        scale = min(max_scale, scale * 2)
+
+    wanted = min(max_scale, scale * ref_pixels / min(edge_lengths(quad)))
+    # small differences are not worth another decode or resize
+    if wanted > scale * 1.1:
+        larger = load_image(image_path, wanted)
+        if larger is None:
+            raise IOError("Could not read image: %s" % image_path)
+        ratio = float(larger.shape[1]) / image.shape[1]
+        tried.append(wanted)
+        # found again at the new scale, for full precision corners
+        with instrument.stage('adaptive_locate'):
+            found = locate_reference(larger, qr, target)
+        image, scale = larger, wanted
+        quad = found if found is not None else quad * ratio
+    elif wanted < scale / 1.1:
+        with instrument.stage('resize'):
+            smaller = cv2.resize(image, (0, 0), fx=wanted / scale, fy=wanted / scale,
+                                 interpolation=cv2.INTER_AREA)
+        quad = quad * (float(smaller.shape[1]) / image.shape[1])
+        image, scale = smaller, wanted
+    return image, scale, tried, quad
+
+def read_inputs(image_path, quads_path, scale=0.125, qr=False, max_side=None, refine=False,
+                target=None, auto=False, ref_pixels=None):
+    '''
+    I/O half of measure_file: decode the image at working scale and read its
+    sidecar. Returns a dict with the working image, its scale, the sidecar
+    quads (full resolution) and, with refine=True, the full resolution
+    grayscale image. With auto=True the book corners (and the sidecar itself,
+    with qr or target) are optional, book_quad is None without them.
+    With ref_pixels the scale is picked per image by adaptive_image, starting
+    from scale (or max_side); the reference found on the way is kept.
+    '''
+    if quads_path is not None:
+        book_quad, ref_quad = load_quads(quads_path, require_book=not auto)
+    elif auto:
+        book_quad = ref_quad = None
+    else:
+        raise ValueError("%s: no corner sidecar given." % image_path)
+    if ref_quad is None and not qr and not target:
+        raise ValueError("%s: no reference corners given." % (quads_path or image_path))
+
+    if max_side:
+        scale = working_scale(image_path, max_side)
+    found, tried = None, None
+    if ref_pixels:
+        clone, scale, tried, found = adaptive_image(image_path, ref_pixels, scale, ref_quad, qr, target)
+    else:
+        clone = load_image(image_path, scale)
+        if clone is None:
+            raise IOError("Could not read image: %s" % image_path)
+
+    gray = None
+    if refine:
+        with instrument.stage('decode_full'):
+            gray = read_image(image_path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise IOError("Could not read image: %s" % image_path)
+    return {'path': image_path, 'image': clone, 'scale': scale, 'book_quad': book_quad,
+            'reference_quad': ref_quad, 'gray': gray, 'found': found, 'scales_tried': tried}
+
+def robust_references(inputs, ref_quad, real_width, real_height, qr=False, target=None,
+                      sizes=None):
+    '''
+    (image points, plane points) of every reference in the working image, for
+    robust.measure_robust: the finder patterns of the reference QR code and of
+    any other QR code in the photo (sized by payload with sizes, else taken to
+    be real_width x real_height), the target feature matches, or the reference
+    corners.
+    '''
+    import robust
+
+    clone = inputs['image']
+    gray = cv2.cvtColor(clone, cv2.COLOR_BGR2GRAY)
+    if target:
+        from feature_store import FeatureStore
+
+        matched = robust.target_correspondences(FeatureStore.load(target), clone,
+                                                real_width, real_height)
+        if matched is not None:
+            return [matched]
+    if not qr:
+        return [(ref_quad, robust.UNIT_SQUARE * [real_width, real_height])]
+
+    references = [robust.qr_correspondences(gray, ref_quad, real_width, real_height)]
+    try:
+        others = find_qr_references(clone)
+    except ReferenceNotFound:
+        others = []
+    # the reference code itself is found again
+    others = [(quad, payload) for quad, payload in others
+              if cv2.pointPolygonTest(np.float32(ref_quad), tuple(map(float, np.mean(quad, axis=0))), False) < 0]
+    if others and sizes is not None and None in [payload for quad, payload in others]:
+        payloads = read_payloads(inputs['path'], clone, [quad for quad, payload in others],
+                                 inputs['gray'])
+        others = list(zip([quad for quad, payload in others], payloads))
+    for quad, payload in others:
+        try:
+            width, height = reference_size(payload, sizes, real_width, real_height) \
+                if sizes is not None else (real_width, real_height)
+        except ValueError:
+            continue
+        references.append(robust.qr_correspondences(gray, quad, width, height))
+    return references
+
+def measure_inputs(inputs, real_width, real_height, size=DEST_SIZE, qr=False, target=None,
+                   sizes=None, min_confidence=0.5, warp=False, robust=False):
+    '''
+    Compute half of measure_file, on the dict returned by read_inputs.
+    With sizes (a reference table, see reference_table.py) and qr=True, the real
+    reference size comes from the QR payload; real_width and real_height are
+    the fallback for unknown payloads. Without book corners the cover is
+    detected, and flagged for review below min_confidence. With robust=True
+    the lengths come from robust.measure_robust over all references.
+    '''
+    clone, scale = inputs['image'], inputs['scale']
+    book_quad, ref_quad = inputs['book_quad'], inputs['reference_quad']
+    found = inputs.get('found')
+    payload = None
+    if qr and sizes is not None:
+        if found is not None:
+            ref_quad = found
+        else:
+            ref_quad, payload = find_qr_reference(clone, inputs.get('path'), need_payload=True)
+        if payload is None and inputs.get('path'):
+            payload = read_payloads(inputs['path'], clone, [ref_quad], inputs['gray'])[0]
+        real_width, real_height = reference_size(payload, sizes, real_width, real_height)
+    elif found is not None:
+        ref_quad = found
+    elif qr:
+        ref_quad = find_qr_reference(clone, inputs.get('path'))
+    elif target:
+        ref_quad = find_target_reference(clone, target)
+    else:
+        ref_quad = ref_quad * scale
+
+    confidence = None
+    if book_quad is None:
+        import cover_detection
+
+        book_quad, confidence = cover_detection.detect_cover(clone, ref_quad)
+        if book_quad is None:
+            raise ValueError("No book cover found in the image.")
+        # back to full resolution, same as sidecar corners
+        book_quad = book_quad / scale
+
+    gray = inputs['gray']
+    if gray is not None:
+        # exact scale of the decoded working image (the decoder rounds sizes)
+        scale_xy = np.array([float(clone.shape[1]) / gray.shape[1],
+                             float(clone.shape[0]) / gray.shape[0]])
+        with instrument.stage('refine'):
+            book_quad = refine_corners(gray, book_quad, scale) * scale_xy
+            ref_quad = refine_corners(gray, ref_quad / scale_xy, scale) * scale_xy
+    else:
+        book_quad = book_quad * scale
+    result, warped = measure(clone, book_quad, ref_quad, real_width, real_height, size, warp)
+    if robust:
+        import robust as robust_fit
+
+        references = robust_references(inputs, ref_quad, real_width, real_height, qr, target, sizes)
+        result.update(robust_fit.measure_robust(book_quad, references, size))
+    if payload is not None:
+        result['payload'] = payload.decode('utf-8', 'replace')
+    if confidence is not None:
+        result['book_confidence'] = confidence
+        result['review'] = confidence < min_confidence
+    result['real_width'], result['real_height'] = float(real_width), float(real_height)
+    result['scale'] = float(scale)
+    if inputs.get('scales_tried'):
+        result['scales_tried'] = [float(s) for s in inputs['scales_tried']]
+    return result, warped
+
+def measure_file(image_path, quads_path, real_width, real_height, scale=0.125,
+                 size=DEST_SIZE, qr=False, max_side=None, refine=False, target=None,
+                 sizes=None, auto=False, min_confidence=0.5, warp=False, robust=False,
+                 ref_pixels=None):
+    '''
+    Load an image and its sidecar corners and measure the book.
+    Corners in the sidecar are in full resolution coordinates and get scaled
+    to the working resolution. With max_side the scale is chosen from the image
+    size instead. With qr=True the reference corners come from the QR code
+    detected in the image instead of the sidecar, with target (a saved feature
+    target) they are found by feature matching. With refine=True all corners
+    are refined on the full resolution image before measuring. sizes is the
+    reference table for payload driven reference sizes. With auto=True the book
+    corners are detected when the sidecar has none (see measure_inputs).
+    The perspective corrected image is only made with warp=True. With
+    robust=True the homography is fitted robustly to all references. With
+    ref_pixels the working scale is picked per image (see adaptive_image).
+    '''
+    inputs = read_inputs(image_path, quads_path, scale, qr, max_side, refine, target, auto,
+                         ref_pixels)
+    return measure_inputs(inputs, real_width, real_height, size, qr, target, sizes, min_confidence,
+                          warp, robust)
+
+def measure_books_file(image_path, quads_path, real_width, real_height, scale=0.125,
+                       size=DEST_SIZE, qr=False, max_side=None, sizes=None):
+    '''
+    Load an image and measure every book in it. The references come from the
+    QR codes in the image (qr=True) or from the sidecar. With sizes, each QR
+    code's real size comes from its payload.
+    '''
+    if max_side:
+        scale = working_scale(image_path, max_side)
+    clone = load_image(image_path, scale)
+    if clone is None:
+        raise IOError("Could not read image: %s" % image_path)
+
+    if qr:
+        references = find_qr_references(clone)
+        ref_quads = [quad for quad, payload in references]
+        if sizes is not None:
+            payloads = [payload for quad, payload in references]
+            if None in payloads:
+                payloads = read_payloads(image_path, clone, ref_quads)
+            real = [reference_size(payload, sizes, real_width, real_height)
+                    for payload in payloads]
+            real_width, real_height = [w for w, h in real], [h for w, h in real]
+    else:
+        ref_quad = load_quads(quads_path, require_book=False)[1] if quads_path else None
+        if ref_quad is None:
+            raise ValueError("No reference corners given.")
+        ref_quads = [ref_quad * scale]
+    return {'books': measure_books(clone, ref_quads, real_width, real_height, size)}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless book dimension measurement")
+    ap.add_argument("-i", "--image", required=True, help="Path to image")
+    ap.add_argument("-w", "--real_width", type=float, help="Real Width")
+    ap.add_argument("-H", "--real_height", type=float, help="Real Height")
+    ap.add_argument("-q", "--quads", help="Sidecar JSON/CSV with book and reference corners")
+    ap.add_argument("-s", "--scale", type=float, default=0.125, help="Working resolution scale")
+    ap.add_argument("-m", "--max_side", type=int, help="Pick the scale per image, longer side in pixels")
+    ap.add_argument("--ref_pixels", type=int,
+                    help="Pick the smallest scale per image at which the reference is this many "
+                         "pixels across; --scale/--max_side give the first scale tried")
+    ap.add_argument("-r", "--refine", action="store_true",
+                    help="Refine corners on the full resolution image")
+    ap.add_argument("--warped", help="Save the perspective corrected image to this path")
+    ap.add_argument("--qr", action="store_true", help="Use the QR code in the image as reference")
+    ap.add_argument("--qr_size", type=float, help="Real side length of the printed QR code")
+    ap.add_argument("-t", "--target", help="Saved feature target (.npz) to find the reference with")
+    ap.add_argument("--table", help="JSON/CSV table of QR payload -> real reference size")
+    ap.add_argument("--payload_size", action="store_true",
+                    help="Read the real reference size from the QR payload (e.g. REF-4cm), "
+                         "with --table for payloads not in it")
+    ap.add_argument("-a", "--auto", action="store_true",
+                    help="Detect the book corners when the sidecar has none")
+    ap.add_argument("--min_confidence", type=float, default=0.5,
+                    help="With --auto, flag results below this detection confidence for review")
+    ap.add_argument("--robust", action="store_true",
+                    help="Fit the reference homography robustly to all reference points and fuse references")
+    ap.add_argument("--multi", action="store_true", help="Detect and measure every book in the photo")
+    ap.add_argument("--timings", action="store_true", help="Add per stage timings to the output")
+    ap.add_argument("--memory", action="store_true", help="With --timings, also trace peak allocations")
+    ap.add_argument("--profile", action="store_true", help="Run under cProfile, stats go to stderr")
+    args = ap.parse_args(argv)
+
+    sizes = None
+    if args.table or args.payload_size:
+        if not args.qr:
+            ap.error("--table and --payload_size require --qr")
+        sizes = reference_table.load_sizes(args.table, args.payload_size)
+    if args.qr:
+        if args.qr_size is None and sizes is None:
+            ap.error("--qr requires --qr_size (or --table / --payload_size)")
+        if args.qr_size is not None:
+            args.real_width = args.real_height = args.qr_size
+    elif args.real_width is None or args.real_height is None:
+        ap.error("--real_width and --real_height are required without --qr")
+
+    quads_path = args.quads or find_sidecar(args.image)
+    if quads_path is None and not ((args.multi or args.auto) and (args.qr or args.target)):
+        print("No corner sidecar found for %s" % args.image, file=sys.stderr)
+        return 1
+
+    if args.timings:
+        instrument.enable(memory=args.memory)
+        instrument.begin(args.image)
+
+    run = instrument.profile if args.profile else (lambda func, *a, **kw: func(*a, **kw))
+    try:
+        if args.multi:
+            warped = None
+            result = run(measure_books_file, args.image, quads_path, args.real_width,
+                         args.real_height, args.scale, qr=args.qr, max_side=args.max_side,
+                         sizes=sizes)
+        else:
+            result, warped = run(measure_file, args.image, quads_path, args.real_width,
+                                 args.real_height, args.scale, qr=args.qr,
+                                 max_side=args.max_side, refine=args.refine, target=args.target,
+                                 sizes=sizes, auto=args.auto, min_confidence=args.min_confidence,
+                                 warp=bool(args.warped), robust=args.robust,
+                                 ref_pixels=args.ref_pixels)
+    except (IOError, ValueError) as e:
+        print(json.dumps({'image': args.image, 'status': 'error', 'error': str(e)}))
+        return 1
+
+    if args.timings:
+        result['timings'] = instrument.end()['stages']
+
+    if args.warped and warped is not None:
+        cv2.imwrite(args.warped, warped)
+
+    result['image'] = args.image
+    result['status'] = 'ok'
+    print(json.dumps(result))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
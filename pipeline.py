@@ -0,0 +1,156 @@
+'''
+Staged measurement pipeline: decode on threads, compute on processes.
+
+    paths -> [read threads] -> bounded queue -> [compute processes] -> records
+
+The read stage (file I/O, JPEG decode at working scale, sidecar, cache lookup)
+runs on a pool of threads; OpenCV releases the GIL while decoding, so threads
+overlap I/O and decode. The compute stage (QR detection, refinement,
+homography, measurement) runs in a process pool. The queue between the two
+stages and the number of images in flight in the process pool are bounded,
+which keeps memory predictable and makes a slow stage hold back the other.
+
+Used by batch.py with --io_threads; records are the same as batch.measure_one's.
+'''
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import time
+
+import instrument
+import measure
+from batch import get_cache, get_sizes, result_key, sidecar_optional
+
+_DONE = object()
+
+def read_stage(path, options):
+    '''
+    Thread side: returns (record, key, inputs). inputs is None when the record
+    is already complete (error or cache hit).
+    '''
+    # thread CPU time: the other readers run in the same process
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    record = {'image': path}
+    key = None
+    try:
+        quads_path = measure.find_sidecar(path)
+        if quads_path is None and not sidecar_optional(options):
+            raise IOError('no corner sidecar found')
+
+        cache = get_cache(options)
+        if cache is not None:
+            key = result_key(path, quads_path, options)
+            result = cache.get(key)
+            if result is not None:
+                record.update(result)
+                record.setdefault('status', 'ok')
+                record['cached'] = True
+                return record, key, None
+
+        inputs = measure.read_inputs(path, quads_path, options['scale'], options['qr'],
+                                     options.get('max_side'), options.get('refine', False),
+                                     options.get('target'), options.get('auto', False),
+                                     options.get('ref_pixels'))
+    except measure.ReferenceNotFound as e:
+        # same as batch.measure_one: remembered, so the image is not searched again
+        record.update(status='error', error=str(e), no_reference=True)
+        if cache is not None and key is not None:
+            cache.put(key, {'status': 'error', 'error': str(e), 'no_reference': True})
+        return record, key, None
+    except Exception as e:
+        record.update(status='error', error=str(e))
+        return record, key, None
+
+    if options.get('timings'):
+        record['timings'] = {'read': {'wall': time.perf_counter() - start,
+                                      'cpu': time.thread_time() - cpu_start, 'calls': 1}}
+    return record, key, inputs
+
+def compute_stage(job):
+    '''
+    Process side: measure already decoded inputs, never raises.
+    '''
+    record, inputs, options = job
+    if options.get('timings'):
+        instrument.enable(memory=options.get('memory', False))
+        instrument.begin(record['image'])
+    try:
+        result, warped = measure.measure_inputs(inputs, options['real_width'], options['real_height'],
+                                                qr=options['qr'], target=options.get('target'),
+                                                sizes=get_sizes(options),
+                                                min_confidence=options.get('min_confidence', 0.5),
+                                                robust=options.get('robust', False))
+        record.update(result)
+        record['status'] = 'ok'
+    except measure.ReferenceNotFound as e:
+        record.update(status='error', error=str(e), no_reference=True)
+    except Exception as e:
+        record.update(status='error', error=str(e))
+    timings = instrument.end()
+    if timings is not None:
+        record.setdefault('timings', {}).update(timings['stages'])
+    return record
+
+def _mp_context():
+    '''
+    Workers are started on demand while the reader threads run; forking then
+    would copy locks held by those threads, so never fork from this process.
+    '''
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def _reader(paths, lock, options, out):
+    while True:
+        with lock:
+            path = next(paths, None)
+        if path is None:
+            out.put(_DONE)
+            return
+        out.put(read_stage(path, options))
+
+def run(paths, options, io_threads=4, workers=None, queue_size=16):
+    '''
+    Measure all images; yields one record per image in completion order.
+    '''
+    decoded = queue.Queue(maxsize=queue_size)
+    lock = threading.Lock()
+    path_iter = iter(paths)
+    cache = get_cache(options)
+    pending = {}
+    readers_left = io_threads
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=_mp_context(),
+                                                initializer=get_sizes,
+                                                initargs=(options,)) as pool:
+        threads = [threading.Thread(target=_reader, args=(path_iter, lock, options, decoded))
+                   for _ in range(io_threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        while readers_left or pending:
+            if pending:
+                # only block on the pool when it is full or nothing is left to read
+                block = not readers_left or len(pending) >= queue_size
+                done, _ = concurrent.futures.wait(list(pending), timeout=None if block else 0,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    record = future.result()
+                    if cache is not None and key is not None and (record['status'] == 'ok' or
+                                                                  record.get('no_reference')):
+                        # status included: cached no_reference errors stay errors
+                        cache.put(key, dict((k, v) for k, v in record.items()
+                                            if k not in ('image', 'timings')))
+                    yield record
+
+            if readers_left and len(pending) < queue_size:
+                item = decoded.get()
+                if item is _DONE:
+                    readers_left -= 1
+                    continue
+                record, key, inputs = item
+                if inputs is None:
+                    yield record
+                else:
+                    pending[pool.submit(compute_stage, (record, inputs, options))] = key
@@ -1,22 +1,280 @@
 # Reference: http://www.learnopencv.com/barcode-and-qr-code-scanner-using-zbar-and-opencv/
 # Python 2/3 support
 from __future__ import print_function
-import pyzbar.pyzbar as pyzbar
 import numpy as np
 import cv2
+import instrument
+from utils import order_points, refine_corners
+
+# zbar is optional, the OpenCV detector is used first (see locate)
+_pyzbar = []
+
+# pyzbar module, imported on first use, or None if it is not installed
+def zbar():
+
+  if not _pyzbar:
+    try:
+      import pyzbar.pyzbar as pyzbar
+    except ImportError:
+      pyzbar = None
+    _pyzbar.append(pyzbar)
+  return _pyzbar[0]
+
+def decode(im, verbose=True) :
+  if zbar() is None:
+    raise ImportError("pyzbar is required to decode QR codes with zbar")
 
-def decode(im) :
   # Find barcodes and QR codes
-  decodedObjects = pyzbar.decode(im)
+  with instrument.stage('qr_decode'):
+    decodedObjects = zbar().decode(im)
 
   # Print results
-  for obj in decodedObjects:
-    print('Type : ', obj.type)
-    print('Data : ', obj.data,'\n')
+  if verbose:
+    for obj in decodedObjects:
+      print('Type : ', obj.type)
+      print('Data : ', obj.data,'\n')
 
   return decodedObjects
 
 
+# Find the QR code used as reference shape, corners ordered as
+# top left -> top right -> bottom right -> bottom left
+def find_reference(im, payload=None):
+
+  for decodedObject in decode(im, verbose=False):
+    if decodedObject.type != 'QRCODE':
+      continue
+    if payload is not None and decodedObject.data != payload:
+      continue
+    points = [(point.x, point.y) for point in decodedObject.location]
+    return order_points(points), decodedObject.data
+
+  return None, None
+
+
+# (key, image shape, max_side) of searches that found no QR code, not repeated
+_failures = set()
+
+_detector = None
+
+def opencv_detector():
+  global _detector
+  if _detector is None:
+    _detector = cv2.QRCodeDetector()
+  return _detector
+
+
+# True if quad can be the outline of a QR code seen in perspective: convex,
+# no edge much shorter than the longest one and opposite edges nearly
+# parallel. OpenCV's detector returns badly wrong corners for small codes
+# (a corner on a finder pattern, two identical corners), which fail this.
+def plausible_quad(quad, min_ratio=0.5, max_angle=20.0):
+
+  quad = np.float32(quad).reshape(4, 2)
+  edges = np.roll(quad, -1, axis=0) - quad
+  lengths = np.linalg.norm(edges, axis=1)
+  if lengths.min() < max(min_ratio * lengths.max(), 1.0) or not cv2.isContourConvex(quad):
+    return False
+  for a, b in ((edges[0], -edges[2]), (edges[1], -edges[3])):
+    cos = a.dot(b) / (np.linalg.norm(a) * np.linalg.norm(b))
+    if cos < np.cos(np.radians(max_angle)):
+      return False
+  return True
+
+
+# Scales to run OpenCV's detector at, in turn: a copy at most max_side pixels
+# across, then the full image, then enlarged copies (up to 3 * max_side) on
+# which small codes are found with the right corners.
+def detect_scales(shape, max_side=640):
+
+  scale = min(1.0, float(max_side) / max(shape[:2]))
+  scales = [scale] + ([1.0] if scale < 1 else [])
+  return scales + [f for f in (2.0, 3.0) if f * max(shape[:2]) <= 3 * max_side]
+
+
+# Fast QR localisation: OpenCV's detector on a small grayscale copy of the
+# image first, on larger copies while the corners it finds are implausible,
+# zbar on the whole image only if that fails. A code less than min_side
+# pixels across is also looked for on the next larger copy, its corners are
+# often a few pixels off. The payload is only decoded when asked for, on a
+# crop around the code.
+# key identifies the image (e.g. its path); searches that found nothing are
+# remembered and not repeated. The same image at another scale or with another
+# max_side is searched again.
+# Returns (ordered corners, payload or None), or (None, None).
+def locate(im, need_payload=False, max_side=640, key=None, min_side=40):
+
+  if key is not None:
+    key = (key, im.shape, max_side)
+    if key in _failures:
+      return None, None
+
+  gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
+
+  quad = None
+  for scale in detect_scales(gray.shape, max_side):
+    if scale == 1:
+      resized = gray
+    else:
+      interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+      resized = cv2.resize(gray, (0, 0), fx=scale, fy=scale, interpolation=interpolation)
+    with instrument.stage('qr_locate'):
+      found, points = opencv_detector().detect(resized)
+    if found and points is not None and plausible_quad(points):
+      points = points.reshape(-1, 2)
+      quad, found_scale = order_points(points / scale), scale
+      if np.linalg.norm(np.roll(points, -1, axis=0) - points, axis=1).min() >= min_side:
+        break
+
+  if quad is not None:
+    if found_scale < 1:
+      # precision lost to the downscaling is recovered on the full image
+      with instrument.stage('qr_refine'):
+        quad = refine_corners(gray, quad, found_scale)
+  elif zbar() is not None:
+    quad, payload = find_reference(gray)
+    if quad is not None:
+      return quad, payload
+
+  if quad is None:
+    if key is not None:
+      _failures.add(key)
+    return None, None
+
+  payload = decode_roi(gray, quad) if need_payload else None
+  return quad, payload
+
+
+# Decode the payload of the QR code at quad, looking only at a padded crop
+def decode_roi(gray, quad, pad=0.3):
+
+  x0, y0 = quad.min(axis=0)
+  x1, y1 = quad.max(axis=0)
+  px, py = pad * (x1 - x0), pad * (y1 - y0)
+  h, w = gray.shape[:2]
+  x0, y0 = int(max(0, x0 - px)), int(max(0, y0 - py))
+  x1, y1 = int(min(w, x1 + px + 1)), int(min(h, y1 + py + 1))
+  roi = gray[y0:y1, x0:x1]
+
+  if zbar() is not None:
+    for decodedObject in decode(roi, verbose=False):
+      if decodedObject.type == 'QRCODE':
+        return decodedObject.data
+    return None
+
+  with instrument.stage('qr_decode'):
+    data, points, straight = opencv_detector().detectAndDecode(roi)
+  return data.encode('utf-8') if data else None
+
+
+# All QR codes in the image, as (ordered corners, payload) pairs. Without
+# zbar the codes are located with OpenCV's detector on the copies of
+# detect_scales, as in locate, and the payloads (None otherwise) are only
+# decoded when asked for: decoding needs larger codes than locating. If the
+# multi code detector finds none, the single code found by locate is used.
+def find_references(im, need_payload=False, max_side=640):
+
+  if zbar() is None:
+    gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) if im.ndim == 3 else im
+    quads, found_scale = [], 1.0
+    for scale in detect_scales(gray.shape, max_side):
+      if scale == 1:
+        resized = gray
+      else:
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        resized = cv2.resize(gray, (0, 0), fx=scale, fy=scale, interpolation=interpolation)
+      with instrument.stage('qr_locate'):
+        found, points = opencv_detector().detectMulti(resized)
+      if not found or points is None:
+        continue
+      points = points.reshape(-1, 4, 2)
+      plausible = [order_points(p / scale) for p in points if plausible_quad(p)]
+      if len(plausible) > len(quads):
+        quads, found_scale = plausible, scale
+      if len(plausible) == len(points):
+        break
+    if not quads:
+      quad, payload = locate(gray, need_payload, max_side)
+      return [(quad, payload)] if quad is not None else []
+    if found_scale < 1:
+      with instrument.stage('qr_refine'):
+        quads = [refine_corners(gray, quad, found_scale) for quad in quads]
+    return [(quad, decode_roi(gray, quad) if need_payload else None) for quad in quads]
+
+  references = []
+  for decodedObject in decode(im, verbose=False):
+    if decodedObject.type != 'QRCODE':
+      continue
+    points = [(point.x, point.y) for point in decodedObject.location]
+    references.append((order_points(points), decodedObject.data))
+
+  return references
+
+
+# Corners of the three finder patterns of the QR code at quad, for a
+# homography from many points instead of the four outer corners only.
+# The code is rectified to a side x side square using quad, the finder
+# patterns (dark squares nested twice) are found there and mapped back, so
+# an inaccurate quad does not move them. The module count is estimated from
+# the finder size (7 modules).
+# Returns (image points, points in units of the QR side) with the outer
+# corners of the code last, or None if the three patterns are not found.
+def finder_points(gray, quad, side=280, pad=0.15):
+
+  quad = np.float32(quad).reshape(4, 2)
+  margin = pad * side
+  size = int(round(side + 2 * margin))
+  square = np.float32([[0, 0], [side, 0], [side, side], [0, side]]) + margin
+  H = cv2.getPerspectiveTransform(quad, square)
+  with instrument.stage('qr_finders'):
+    canon = cv2.warpPerspective(gray, H, (size, size), flags=cv2.INTER_LINEAR)
+    _, binary = cv2.threshold(canon, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    contours, hierarchy = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2:]
+  if hierarchy is None:
+    return None
+
+  # expected corners of the code the three finder patterns sit in
+  expected = square[[0, 1, 3]]
+  finders = [None, None, None]
+  for i, contour in enumerate(contours):
+    child = hierarchy[0][i][2]
+    if child < 0 or hierarchy[0][child][2] < 0:
+      continue
+    area = cv2.contourArea(contour)
+    if not ((0.08 * side) ** 2 <= area <= (0.4 * side) ** 2):
+      continue
+    hull = cv2.convexHull(contour)
+    approx = cv2.approxPolyDP(hull, 0.05 * cv2.arcLength(hull, True), True)
+    if len(approx) != 4:
+      continue
+    corners = order_points(approx.reshape(4, 2))
+    distances = np.linalg.norm(expected - corners.mean(axis=0), axis=1)
+    k = int(np.argmin(distances))
+    if distances[k] < 0.35 * side and (finders[k] is None or area > finders[k][0]):
+      finders[k] = (area, corners)
+  if any(f is None for f in finders):
+    return None
+
+  # module count: versions have 21, 25, 29, ... modules
+  finder_side = np.mean([np.linalg.norm(np.roll(c, -1, axis=0) - c, axis=1).mean() for a, c in finders])
+  n = 7.0 * side / finder_side
+  n = max(21, 21 + 4 * int(round((n - 21) / 4.0)))
+  unit = np.float32([[0, 0], [7, 0], [7, 7], [0, 7]]) / n
+  offsets = np.float32([[0, 0], [(n - 7.0) / n, 0], [0, (n - 7.0) / n]])
+
+  # contour vertices sit on pixel centres inside the pattern, move them onto
+  # the actual corners
+  corners = np.float32(np.concatenate([c for a, c in finders])).reshape(-1, 1, 2)
+  win = max(2, int(side / n / 3))
+  criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+  cv2.cornerSubPix(canon, corners, (win, win), (-1, -1), criteria)
+
+  canon_points = np.concatenate([corners.reshape(-1, 2), square])
+  unit_points = np.concatenate([unit + o for o in offsets] + [np.float32([[0, 0], [1, 0], [1, 1], [0, 1]])])
+  image_points = cv2.perspectiveTransform(canon_points.reshape(-1, 1, 2), np.linalg.inv(H)).reshape(-1, 2)
+  return image_points, unit_points
+
+
 # Display barcode and QR code location
 def display(im, decodedObjects):
 
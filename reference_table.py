@@ -0,0 +1,106 @@
+'''
+Physical sizes of the printed reference codes, looked up by QR payload.
+
+A table maps payload IDs to (width, height), so one batch can mix reference
+stickers of different sizes. It is read once per process and kept in memory:
+
+JSON : {"<payload>": [width, height], ...}    ([side] or a number for squares)
+CSV  : one row per code, "payload,width,height"  (height optional)
+
+Payloads not in the table may carry their size themselves, e.g. "REF-4cm" or
+"REF-4x4.5cm" (width x height, in the unit used for all measurements). The
+scripts only read it with --payload_size; --table alone leaves other payloads
+unknown.
+'''
+import csv
+import json
+import re
+
+SIZE_IN_PAYLOAD = re.compile(r'(\d+(?:\.\d+)?)(?:x(\d+(?:\.\d+)?))?\s*cm\b')
+
+# tables loaded in this process, by path
+_tables = {}
+
+# size tables of this process, by (path, payload_size)
+_sizes = {}
+
+def _size(value):
+    if isinstance(value, (int, float)):
+        return float(value), float(value)
+    if len(value) == 1:
+        return float(value[0]), float(value[0])
+    return float(value[0]), float(value[1])
+
+def load_table(path):
+    '''
+    Payload -> (width, height) dict, read once per process.
+    '''
+    if path in _tables:
+        return _tables[path]
+
+    table = {}
+    if path.lower().endswith('.csv'):
+        with open(path) as f:
+            for row in csv.reader(f):
+                row = [cell.strip() for cell in row if cell.strip()]
+                if len(row) < 2:
+                    continue
+                try:
+                    table[row[0]] = _size([float(v) for v in row[1:3]])
+                except ValueError:
+                    # header line
+                    continue
+    else:
+        with open(path) as f:
+            for payload, value in json.load(f).items():
+                table[payload] = _size(value)
+    _tables[path] = table
+    return table
+
+class SizeTable(dict):
+    '''
+    Payload -> (width, height) table. With payload_size, payloads that are
+    not in it are parsed for their size (parse_payload).
+    '''
+    def __init__(self, table=(), payload_size=True):
+        dict.__init__(self, table)
+        self.payload_size = payload_size
+
+def load_sizes(path=None, payload_size=False):
+    '''
+    Reference sizes of --table and --payload_size, made once per process:
+    None when neither is given, else a SizeTable.
+    '''
+    if path is None and not payload_size:
+        return None
+    key = (path, payload_size)
+    if key not in _sizes:
+        _sizes[key] = SizeTable(load_table(path) if path else {}, payload_size)
+    return _sizes[key]
+
+def parse_payload(payload):
+    '''
+    Size written in the payload itself, or None.
+    '''
+    match = SIZE_IN_PAYLOAD.search(payload)
+    if match is None:
+        return None
+    width = float(match.group(1))
+    height = float(match.group(2)) if match.group(2) else width
+    return width, height
+
+def lookup(payload, table=None):
+    '''
+    (width, height) of the reference with this payload (bytes or str), or None.
+    Payloads not in the table are parsed for their size unless the table is a
+    SizeTable without payload_size.
+    '''
+    if payload is None:
+        return None
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', 'replace')
+    if table is not None and payload in table:
+        return table[payload]
+    if not getattr(table, 'payload_size', True):
+        return None
+    return parse_payload(payload)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+'''
+Re-measurement From Stored Results
+==================
+
+The real edge lengths are a pure rescale of pixel lengths that do not depend
+on the real reference size:
+
+    top = book_edges[top] / reference_edges[top] * real_width     (same for bottom)
+    left = book_edges[left] / reference_edges[left] * real_height (same for right)
+
+where book_edges and reference_edges are the edge lengths of the book and of
+its reference after rectification (see measure.measure). Every record written
+by measure.py, batch.py or server.py carries them, so when only the real
+reference size or the reference table changes, a whole archive of results is
+measured again from them without reading a single image. Results written
+before the edges were stored are handled too: the edges are recomputed from
+the stored homography and corners.
+
+Records with the robust fit (--robust, see robust.py) are rescaled by the
+ratio of new to old reference size; that is exact unless the other QR codes
+they were fused with changed size differently.
+
+Input and output are any format batch.py writes except CSV, which does not
+keep the corners: .jsonl (or stdout), .npz chunks, .parquet, .arrow.
+
+Usage
+-----
+remeasure.py --input [<results.jsonl|.npz|.parquet|.arrow>] [--output <results>]
+             (--real_width <real_width> --real_height <real_height> | --qr_size <qr_size>)
+             [--table <sizes.json> | --payload_size]
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import geometry
+import reference_table
+import results
+
+def load_columns(path):
+    '''
+    All columns of a results file, see results.py.
+    '''
+    if path.lower().endswith('.csv'):
+        raise ValueError("CSV results do not keep the corners, cannot remeasure %s" % path)
+    if path.lower().endswith(('.npz', '.parquet', '.arrow')):
+        return results.read_columns(path)
+    with open(path) as f:
+        return results.columns([json.loads(line) for line in f if line.strip()])
+
+def stored_edges(cols):
+    '''
+    (book_edges, reference_edges) of every record, shape (N, 4) each. Where
+    they were not stored, they come from the homography and the corners.
+    '''
+    n = len(cols['status'])
+    book = cols.get('book_edges', np.full((n, 4), np.nan))
+    ref = cols.get('reference_edges', np.full((n, 4), np.nan))
+    missing = ~(np.isfinite(book).all(axis=1) & np.isfinite(ref).all(axis=1))
+    if missing.any() and 'homography' in cols:
+        H = cols['homography'][missing]
+        book, ref = book.copy(), ref.copy()
+        book[missing] = geometry.edge_lengths(geometry.project(H, cols['book_quad'][missing]))
+        ref[missing] = geometry.edge_lengths(geometry.project(H, cols['reference_quad'][missing]))
+    return book, ref
+
+def reference_sizes(cols, real_width, real_height, sizes=None):
+    '''
+    New real (width, height) of every record's reference, arrays of shape (N,):
+    from its payload with the sizes table, else real_width and real_height.
+    NaN where neither is known.
+    '''
+    n = len(cols['status'])
+    width = np.full(n, np.nan if real_width is None else float(real_width))
+    height = np.full(n, np.nan if real_height is None else float(real_height))
+    if sizes is not None and 'payload' in cols:
+        payloads = cols['payload']
+        # an archive has few distinct payloads, each is looked up once
+        for payload in np.unique(payloads):
+            size = reference_table.lookup(str(payload), sizes) if payload else None
+            if size is not None:
+                rows = payloads == payload
+                width[rows], height[rows] = size
+    return width, height
+
+def remeasure(cols, real_width, real_height, sizes=None):
+    '''
+    Columns with the lengths of every successful record recomputed for the
+    new reference sizes. Records whose reference size is unknown become errors.
+    '''
+    cols = dict(cols)
+    n = len(cols['status'])
+    width, height = reference_sizes(cols, real_width, real_height, sizes)
+    ok = cols['status'] == 'ok'
+    unknown = ok & ~(np.isfinite(width) & np.isfinite(height))
+
+    book, ref = stored_edges(cols)
+    lengths = geometry.real_lengths(book, ref, width, height)
+
+    # the robust fit is not a ratio of stored edges, it is rescaled instead
+    old_width = cols.get('real_width', np.full(n, np.nan))
+    old_height = cols.get('real_height', np.full(n, np.nan))
+    robust = np.isfinite(cols['width']) if 'width' in cols else np.zeros(n, bool)
+    scale_width, scale_height = width / old_width, height / old_height
+
+    for i, name in enumerate(('top', 'bottom', 'left', 'right')):
+        scale = scale_width if i < 2 else scale_height
+        values = np.where(robust, cols[name] * scale, lengths[:, i])
+        cols[name] = np.where(ok & ~unknown, values, cols[name])
+    for name, scale in (('width', scale_width), ('width_std', scale_width),
+                        ('height', scale_height), ('height_std', scale_height)):
+        if name in cols:
+            cols[name] = np.where(ok & ~unknown & robust, cols[name] * scale, cols[name])
+    cols['real_width'] = np.where(ok & ~unknown, width, old_width)
+    cols['real_height'] = np.where(ok & ~unknown, height, old_height)
+
+    if unknown.any():
+        cols['status'] = np.where(unknown, 'error', cols['status'])
+        message = np.array(["Unknown reference payload: %r" % (str(p),) for p in cols['payload']])
+        cols['error'] = np.where(unknown, message, cols['error'])
+        for name in ('top', 'bottom', 'left', 'right'):
+            cols[name] = np.where(unknown, np.nan, cols[name])
+    return cols
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Measure stored results again for new reference sizes")
+    ap.add_argument("-i", "--input", required=True, help="Results of batch.py (.jsonl, .npz, .parquet, .arrow)")
+    ap.add_argument("-o", "--output", help="Write the new results here instead of stdout (same formats)")
+    ap.add_argument("-w", "--real_width", type=float, help="Real reference width")
+    ap.add_argument("-H", "--real_height", type=float, help="Real reference height")
+    ap.add_argument("--qr_size", type=float, help="Real side length of the printed QR code")
+    ap.add_argument("--table", help="JSON/CSV table of QR payload -> real reference size")
+    ap.add_argument("--payload_size", action="store_true",
+                    help="Read the real reference size from the QR payload (e.g. REF-4cm), "
+                         "with --table for payloads not in it")
+    ap.add_argument("--chunk_records", type=int, default=1024,
+                    help="Records per columnar chunk (.npz, .parquet, .arrow)")
+    args = ap.parse_args(argv)
+
+    if args.qr_size is not None:
+        args.real_width = args.real_height = args.qr_size
+    sizes = reference_table.load_sizes(args.table, args.payload_size)
+    if sizes is None and (args.real_width is None or args.real_height is None):
+        ap.error("--real_width and --real_height (or --qr_size, --table, --payload_size) are required")
+
+    if args.output and os.path.abspath(args.output) == os.path.abspath(args.input):
+        ap.error("--output must not be the --input file")
+
+    try:
+        cols = load_columns(args.input)
+    except (IOError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    if not cols or not len(cols['status']):
+        print("No records in %s" % args.input, file=sys.stderr)
+        return 1
+
+    cols = remeasure(cols, args.real_width, args.real_height, sizes)
+    with results.open_writer(args.output, args.chunk_records, False, sys.stdout) as writer:
+        writer.write_columns(cols)
+    failed = int((cols['status'] != 'ok').sum())
+    print("%d records, %d failed" % (len(cols['status']), failed), file=sys.stderr)
+    return 0 if failed == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+'''
+Columnar result writers.
+
+Records (one dict per image, as written by batch.py) are collected in batches
+of chunk_size and written column by column, so millions of measurements can be
+read back in bulk instead of parsing lines:
+
+.npz     : one append-only chunk file per batch, <name>.00000.npz, <name>.00001.npz, ...
+           next to the given path; new runs continue the numbering
+.parquet : one row group per batch (needs pyarrow)
+.arrow   : Arrow IPC stream, one record batch per batch (needs pyarrow)
+.csv     : one row per record, homography flattened to h0 .. h8
+.jsonl   : one JSON record per line (anything else is written as JSON lines too)
+
+Columns: image, status, error, payload, cached, no_reference, review, top,
+bottom, left, right, real_width, real_height, width, height, width_std,
+height_std (with --robust), scale (the working scale used), book_confidence
+(with --auto, review is set below --min_confidence), homography (3x3), book_quad and
+reference_quad (4x2, image coordinates), book_edges and reference_edges (the
+rectified pixel edge lengths, see remeasure.py), timings (the per stage
+timings as a JSON string) and extra (every other key of the record, e.g.
+scales_tried, as a JSON object string). Missing values are NaN or empty strings.
+
+Writers take records one at a time (write) or whole columns (write_columns,
+which the columnar formats write without going through records).
+'''
+import abc
+import csv
+import glob
+import json
+import os
+
+import numpy as np
+
+# pyarrow is optional and slow to import, loaded on first use
+_pyarrow = []
+
+def arrow():
+    '''
+    pyarrow with its ipc and parquet modules, or None if it is not installed.
+    '''
+    if not _pyarrow:
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            pyarrow = None
+        _pyarrow.append(pyarrow)
+    return _pyarrow[0]
+
+STRING_COLUMNS = ('image', 'status', 'error', 'payload')
+BOOL_COLUMNS = ('cached', 'no_reference', 'review')
+FLOAT_COLUMNS = ('top', 'bottom', 'left', 'right', 'real_width', 'real_height',
+                 'width', 'height', 'width_std', 'height_std', 'scale', 'book_confidence')
+# flags that records carry, also when False, whenever the column has a value
+FLAG_WITH = {'review': 'book_confidence'}
+ARRAY_COLUMNS = (('homography', (3, 3)), ('book_quad', (4, 2)), ('reference_quad', (4, 2)),
+                 ('book_edges', (4,)), ('reference_edges', (4,)))
+# record keys with a column of their own, the others go to the extra column
+KNOWN_KEYS = frozenset(STRING_COLUMNS + BOOL_COLUMNS + FLOAT_COLUMNS +
+                       tuple(name for name, shape in ARRAY_COLUMNS) + ('timings',))
+
+def columns(records):
+    '''
+    Records as a dict of numpy arrays, one entry per column.
+    '''
+    cols = {}
+    for name in STRING_COLUMNS:
+        cols[name] = np.array([str(r.get(name) or '') for r in records], dtype=str)
+    for name in BOOL_COLUMNS:
+        cols[name] = np.array([bool(r.get(name, False)) for r in records], dtype=bool)
+    for name in FLOAT_COLUMNS:
+        cols[name] = np.array([r.get(name, np.nan) for r in records], dtype=float)
+    for name, shape in ARRAY_COLUMNS:
+        values = np.full((len(records),) + shape, np.nan)
+        for i, r in enumerate(records):
+            if r.get(name) is not None:
+                values[i] = np.asarray(r[name], dtype=float).reshape(shape)
+        cols[name] = values
+    cols['timings'] = np.array([json.dumps(r['timings']) if 'timings' in r else ''
+                                for r in records], dtype=str)
+    extra = [dict((k, v) for k, v in r.items() if k not in KNOWN_KEYS) for r in records]
+    cols['extra'] = np.array([json.dumps(e) if e else '' for e in extra], dtype=str)
+    return cols
+
+def records(cols):
+    '''
+    Columns (as returned by columns or read_columns) back to one dict per
+    record; NaN values, empty strings and False flags (except those of
+    FLAG_WITH) are left out, as in the records batch.py writes.
+    '''
+    n = len(next(iter(cols.values()))) if cols else 0
+    out = [{} for i in range(n)]
+    for name, values in cols.items():
+        if name == 'timings':
+            for record, value in zip(out, values):
+                if value:
+                    record[name] = json.loads(value)
+        elif name == 'extra':
+            for record, value in zip(out, values):
+                if value:
+                    record.update(json.loads(value))
+        elif values.dtype.kind in 'US':
+            for record, value in zip(out, values.tolist()):
+                if value:
+                    record[name] = value
+        elif values.dtype.kind == 'b':
+            present = values
+            if FLAG_WITH.get(name) in cols:
+                present = np.isfinite(cols[FLAG_WITH[name]])
+            for record, keep, value in zip(out, present.tolist(), values.tolist()):
+                if keep:
+                    record[name] = value
+        else:
+            finite = np.isfinite(values.reshape(n, -1)).all(axis=1)
+            for record, ok, value in zip(out, finite, values.tolist()):
+                if ok:
+                    record[name] = value
+    return out
+
+class ResultWriter(abc.ABC):
+    '''
+    Collects records and hands them to write_batch chunk_size at a time.
+    Subclasses implement write_batch.
+    '''
+    def __init__(self, path, chunk_size=1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.pending = []
+
+    def write(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.write_batch(self.pending)
+            self.pending = []
+
+    @abc.abstractmethod
+    def write_batch(self, records):
+        '''
+        Write a list of records to the output.
+        '''
+
+    def write_columns(self, cols):
+        for record in records(cols):
+            self.write(record)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class NpzWriter(ResultWriter):
+    '''
+    One compressed .npz file per chunk, never rewritten.
+    '''
+    def __init__(self, path, chunk_size=1024):
+        ResultWriter.__init__(self, path, chunk_size)
+        self.prefix = os.path.splitext(path)[0]
+        self.index = len(chunk_paths(path))
+
+    def write_batch(self, records):
+        self.save(columns(records))
+
+    def write_columns(self, cols):
+        self.flush()
+        for chunk in chunks(cols, self.chunk_size):
+            self.save(chunk)
+
+    def save(self, cols):
+        np.savez_compressed('%s.%05d.npz' % (self.prefix, self.index), **cols)
+        self.index += 1
+
+class ArrowWriter(ResultWriter):
+    '''
+    Parquet row groups or Arrow IPC record batches, one per chunk.
+    '''
+    def __init__(self, path, chunk_size=1024):
+        if arrow() is None:
+            raise ImportError("pyarrow is required to write %s" % path)
+        ResultWriter.__init__(self, path, chunk_size)
+        self.writer = None
+
+    def write_batch(self, records):
+        self.save(columns(records))
+
+    def write_columns(self, cols):
+        self.flush()
+        for chunk in chunks(cols, self.chunk_size):
+            self.save(chunk)
+
+    def save(self, cols):
+        table = arrow_table(cols)
+        pyarrow = arrow()
+        if self.writer is None:
+            if self.path.lower().endswith('.parquet'):
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                self.writer = pyarrow.ipc.new_stream(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        ResultWriter.close(self)
+        if self.writer is not None:
+            self.writer.close()
+
+class CsvWriter(ResultWriter):
+    '''
+    Flat CSV rows; the header is written once per file.
+    '''
+    def __init__(self, path, chunk_size=1024, append=False):
+        ResultWriter.__init__(self, path, chunk_size)
+        new = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a' if append else 'w')
+        self.writer = csv.writer(self.file)
+        if new:
+            self.writer.writerow(STRING_COLUMNS + BOOL_COLUMNS + FLOAT_COLUMNS +
+                                 tuple('h%d' % i for i in range(9)))
+
+    def write_batch(self, records):
+        cols = columns(records)
+        names = STRING_COLUMNS + BOOL_COLUMNS + FLOAT_COLUMNS
+        homography = cols['homography'].reshape(-1, 9)
+        for i in range(len(records)):
+            self.writer.writerow([cols[name][i] for name in names] + homography[i].tolist())
+        self.file.flush()
+
+    def close(self):
+        ResultWriter.close(self)
+        self.file.close()
+
+class JsonlWriter(ResultWriter):
+    '''
+    One JSON record per line, flushed after every record.
+    '''
+    def __init__(self, path, append=False, f=None):
+        ResultWriter.__init__(self, path, chunk_size=1)
+        self.file = open(path, 'a' if append else 'w') if path is not None else f
+
+    def write_batch(self, records):
+        for record in records:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        ResultWriter.close(self)
+        if self.path is not None:
+            self.file.close()
+
+def chunks(cols, size):
+    '''
+    Columns split into consecutive slices of at most size rows.
+    '''
+    n = len(next(iter(cols.values()))) if cols else 0
+    for start in range(0, n, size):
+        yield dict((name, values[start:start + size]) for name, values in cols.items())
+
+def arrow_table(cols):
+    '''
+    pyarrow Table of the columns; fixed size arrays become fixed size lists.
+    '''
+    pyarrow = arrow()
+    arrays, names = [], []
+    for name, values in cols.items():
+        if values.ndim > 1:
+            flat = values.reshape(len(values), -1)
+            values = pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(flat.reshape(-1)), flat.shape[1])
+        else:
+            values = pyarrow.array(values.tolist())
+        arrays.append(values)
+        names.append(name)
+    return pyarrow.Table.from_arrays(arrays, names=names)
+
+def open_writer(path, chunk_size=1024, append=False, f=None):
+    '''
+    Writer for path, picked by its extension. With path None, JSON lines go to f.
+    append only applies to CSV and JSON lines: .npz chunks are always added to
+    the existing ones, Parquet and Arrow files are rewritten.
+    '''
+    ext = os.path.splitext(path)[1].lower() if path else ''
+    if ext == '.npz':
+        return NpzWriter(path, chunk_size)
+    if ext in ('.parquet', '.arrow'):
+        return ArrowWriter(path, chunk_size)
+    if ext == '.csv':
+        return CsvWriter(path, chunk_size, append)
+    return JsonlWriter(path, append, f)
+
+def chunk_paths(path):
+    '''
+    .npz chunk files written for path, in order.
+    '''
+    prefix = os.path.splitext(path)[0]
+    return sorted(glob.glob(glob.escape(prefix) + '.[0-9][0-9][0-9][0-9][0-9].npz'))
+
+def read_columns(path):
+    '''
+    All columns written to path (.npz chunks, .parquet or .arrow), concatenated.
+    '''
+    if path.lower().endswith('.npz'):
+        chunks = [np.load(p) for p in chunk_paths(path)]
+        if not chunks:
+            return {}
+        return dict((name, np.concatenate([c[name] for c in chunks])) for name in chunks[0].files)
+
+    pyarrow = arrow()
+    if pyarrow is None:
+        raise ImportError("pyarrow is required to read %s" % path)
+    if path.lower().endswith('.parquet'):
+        table = pyarrow.parquet.read_table(path)
+    else:
+        with pyarrow.ipc.open_stream(path) as reader:
+            table = reader.read_all()
+    cols = {}
+    shapes = dict(ARRAY_COLUMNS)
+    for name in table.column_names:
+        column = table.column(name)
+        if name in shapes:
+            cols[name] = np.array(column.to_pylist(), dtype=float).reshape((-1,) + shapes[name])
+        else:
+            cols[name] = np.array(column.to_pylist())
+    return cols
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+'''
+Fixed Camera Rig Measurement
+==================
+
+For scanning stations where camera and platen do not move, the homography from
+the image to a top view of the platen is the same for every photo. It is
+computed once from the reference shape (calibration) and saved, later images
+only need their book corners projected through it.
+
+The reference shape is still looked for in every image (sidecar or --qr). If it
+moved more than --tolerance pixels from where it was at calibration, the rig is
+recalibrated from the new position and the rig file is updated.
+
+Warping to the top view (only done with --warped) uses remap tables built once
+per rig, so it is a lookup instead of a warpPerspective per image.
+
+Usage
+-----
+rig.py calibrate --image [<image>] --rig [<rig.npz>] [--quads <sidecar>] [--qr] [--scale 0.125]
+rig.py measure --images [<directory or glob>] --rig [<rig.npz>] --real_width [<w>] --real_height [<h>]
+               [--qr --qr_size <qr_size>] [--tolerance 2.0] [--warped <directory>]
+
+Sidecars are the same as for measure.py; with --qr only the book corners are needed.
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import cv2
+import numpy as np
+
+import buffers
+import geometry
+import measure
+from batch import list_images
+from utils import load_image
+
+class Rig(object):
+    '''
+    Image -> top view homography of a fixed camera rig, with the reference
+    corners it was computed from and (lazily) the remap tables for warping.
+    '''
+    def __init__(self, H, size, reference_quad, scale):
+        self.H = np.asarray(H, dtype=float)
+        self.size = (int(size[0]), int(size[1]))
+        self.reference_quad = np.asarray(reference_quad, dtype=float).reshape(4, 2)
+        self.scale = float(scale)
+        self._maps = None
+
+    @classmethod
+    def calibrate(cls, image_shape, reference_quad, scale, max_size=4096):
+        '''
+        Homography taking the reference shape to an axis aligned square, in a
+        top view large enough to hold the whole image (up to max_size pixels).
+        '''
+        reference_quad = np.asarray(reference_quad, dtype=float).reshape(4, 2)
+        # keep about the same resolution as the image around the reference
+        side = geometry.edge_lengths(reference_quad).mean()
+        square = geometry.rectangle((side + 1, side + 1))
+        H = geometry.homographies(reference_quad, square)[0]
+        if np.isnan(H).any():
+            raise ValueError("Degenerate reference corners, cannot calibrate.")
+
+        # move the projected image into view
+        h, w = image_shape[:2]
+        corners = geometry.project(H[None], geometry.rectangle((w, h))[None])[0]
+        lo = corners.min(axis=0)
+        hi = corners.max(axis=0)
+        shift = np.array([[1, 0, -lo[0]], [0, 1, -lo[1]], [0, 0, 1]], dtype=float)
+        size = np.minimum(np.ceil(hi - lo), max_size)
+        return cls(shift.dot(H), size, reference_quad, scale)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['H'], data['size'], data['reference_quad'], data['scale'])
+
+    def save(self, path):
+        np.savez(path, H=self.H, size=np.array(self.size),
+                 reference_quad=self.reference_quad, scale=self.scale)
+
+    def drift(self, reference_quad):
+        '''
+        Largest corner displacement (pixels) of the reference since calibration.
+        '''
+        diff = np.asarray(reference_quad, dtype=float).reshape(4, 2) - self.reference_quad
+        return float(np.linalg.norm(diff, axis=1).max())
+
+    def maps(self):
+        '''
+        Remap tables for the top view, computed once.
+        '''
+        if self._maps is None:
+            w, h = self.size
+            xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+            grid = np.stack([xs, ys], axis=-1).reshape(1, -1, 2)
+            src = geometry.project(np.linalg.inv(self.H)[None], grid)[0].astype(np.float32)
+            mapx = src[:, 0].reshape(h, w)
+            mapy = src[:, 1].reshape(h, w)
+            # fixed point maps are faster to remap with
+            self._maps = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2)
+        return self._maps
+
+    def warp(self, image):
+        '''
+        Top view of image, in a reused buffer (see buffers.py).
+        '''
+        map1, map2 = self.maps()
+        w, h = self.size
+        dst = buffers.get('rig_warp', (h, w) + image.shape[2:], image.dtype)
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+    def measure(self, book_quad, real_width, real_height, reference_quad=None):
+        '''
+        Real edge lengths of the book, projected through the rig homography.
+        The reference at calibration is used unless reference_quad is given.
+        '''
+        if reference_quad is None:
+            reference_quad = self.reference_quad
+        quads = np.stack([np.asarray(book_quad, dtype=float).reshape(4, 2),
+                          np.asarray(reference_quad, dtype=float).reshape(4, 2)])
+        book, ref = geometry.edge_lengths(geometry.project(np.stack([self.H, self.H]), quads))
+        real = np.array([real_width, real_width, real_height, real_height], dtype=float)
+        top, bottom, left, right = book / ref * real
+        return {'top': top, 'bottom': bottom, 'left': left, 'right': right}
+
+def reference_for(image, quads_path, scale, qr, require_book=True):
+    '''
+    Book and reference corners at working scale (book is None without sidecar,
+    or when the sidecar has none and require_book is False).
+    '''
+    book_quad, ref_quad = None, None
+    if quads_path is not None:
+        book_quad, ref_quad = measure.load_quads(quads_path, require_book)
+        if book_quad is not None:
+            book_quad = book_quad * scale
+        if ref_quad is not None:
+            ref_quad = ref_quad * scale
+    if qr:
+        ref_quad = measure.find_qr_reference(image)
+    if ref_quad is None:
+        raise ValueError("No reference corners given.")
+    return book_quad, ref_quad
+
+def calibrate_main(args):
+    image = load_image(args.image, args.scale)
+    if image is None:
+        print("Could not read image: %s" % args.image, file=sys.stderr)
+        return 1
+    quads_path = args.quads or measure.find_sidecar(args.image)
+    try:
+        # calibration only needs the reference
+        book_quad, ref_quad = reference_for(image, quads_path, args.scale, args.qr, require_book=False)
+    except (IOError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    rig = Rig.calibrate(image.shape, ref_quad, args.scale)
+    rig.save(args.rig)
+    print("Rig saved to %s, top view size %s" % (args.rig, rig.size), file=sys.stderr)
+    return 0
+
+def measure_main(args):
+    rig = Rig.load(args.rig)
+    failed = 0
+    for path in list_images(args.images):
+        record = {'image': path}
+        try:
+            image = load_image(path, rig.scale)
+            if image is None:
+                raise IOError("Could not read image: %s" % path)
+            book_quad, ref_quad = reference_for(image, measure.find_sidecar(path), rig.scale, args.qr)
+            if book_quad is None:
+                raise ValueError("No book corners given.")
+
+            drift = rig.drift(ref_quad)
+            if drift > args.tolerance:
+                rig = Rig.calibrate(image.shape, ref_quad, rig.scale)
+                rig.save(args.rig)
+                record['recalibrated'] = True
+            record['drift'] = drift
+            record.update(rig.measure(book_quad, args.real_width, args.real_height, ref_quad))
+
+            if args.warped:
+                cv2.imwrite(os.path.join(args.warped, os.path.basename(path)), rig.warp(image))
+            record['status'] = 'ok'
+        except (IOError, ValueError) as e:
+            record.update(status='error', error=str(e))
+            failed += 1
+        print(json.dumps(record))
+    return 0 if failed == 0 else 2
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Fixed camera rig measurement")
+    sub = ap.add_subparsers(dest='command')
+
+    cal = sub.add_parser('calibrate', help="Compute and save the rig homography")
+    cal.add_argument("-i", "--image", required=True, help="Path to calibration image")
+    cal.add_argument("-q", "--quads", help="Sidecar JSON/CSV with the reference corners")
+    cal.add_argument("-s", "--scale", type=float, default=0.125, help="Working resolution scale")
+
+    mes = sub.add_parser('measure', help="Measure books with a saved rig")
+    mes.add_argument("-i", "--images", required=True, help="Directory or glob of images")
+    mes.add_argument("-w", "--real_width", type=float, help="Real Width")
+    mes.add_argument("-H", "--real_height", type=float, help="Real Height")
+    mes.add_argument("--qr_size", type=float, help="Real side length of the printed QR code")
+    mes.add_argument("-t", "--tolerance", type=float, default=2.0,
+                     help="Reference drift (pixels) after which the rig is recalibrated")
+    mes.add_argument("--warped", help="Directory to save top view images to")
+
+    for p in (cal, mes):
+        p.add_argument("-r", "--rig", required=True, help="Rig file (.npz)")
+        p.add_argument("--qr", action="store_true", help="Use the QR code in the image as reference")
+    args = ap.parse_args(argv)
+
+    if args.command == 'calibrate':
+        return calibrate_main(args)
+    if args.command == 'measure':
+        if args.qr:
+            if args.qr_size is None:
+                ap.error("--qr requires --qr_size")
+            args.real_width = args.real_height = args.qr_size
+        elif args.real_width is None or args.real_height is None:
+            ap.error("--real_width and --real_height are required without --qr")
+        return measure_main(args)
+    ap.print_help()
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
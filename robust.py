@@ -0,0 +1,153 @@
+'''
+Robust reference homography and fused book dimensions.
+
+The default measurement takes the scale from exactly four reference corners,
+so a single misplaced corner shifts every length. Here each reference gives
+as many correspondences between the image and its own plane (in real units) as
+can be found:
+
+QR code : the corners of its three finder patterns plus its outer corners
+          (qr_code_detection.finder_points)
+target  : every ORB match with the saved target (feature_store.py)
+sidecar : the four reference corners
+
+and a homography between the image and that plane is fitted with USAC MAGSAC
+(RANSAC on older OpenCV), so bad points are dropped. The book corners
+themselves are not part of the fit, their real positions are what is measured.
+As in geometry.measure_quads the book is rectified onto a rectangle; the
+inliers are mapped into it and a least squares affine fit to their plane
+coordinates gives the scale along each book axis, with a standard deviation
+from the fit residuals. Extrapolating the reference homography out to the book
+corners instead would magnify every error of the small reference. Estimates
+from several references are fused by inverse variance (geometry.fuse).
+'''
+import cv2
+import numpy as np
+
+import geometry
+import instrument
+
+ROBUST_METHOD = getattr(cv2, 'USAC_MAGSAC', cv2.RANSAC)
+UNIT_SQUARE = np.float32([[0, 0], [1, 0], [1, 1], [0, 1]])
+
+def plane_homography(image_points, plane_points, threshold=1.0):
+    '''
+    Homography from the image to the reference plane, robust to outliers.
+    threshold is the largest reprojection error of an inlier, in image pixels.
+    Returns (H, inlier mask, RMS reprojection error of the inliers in pixels),
+    or None if no homography is found.
+    '''
+    image_points = np.float32(image_points).reshape(-1, 2)
+    plane_points = np.float32(plane_points).reshape(-1, 2)
+    if len(image_points) < 4:
+        return None
+    with instrument.stage('robust_homography'):
+        if len(image_points) == 4:
+            # exactly determined, nothing to vote on
+            H_inv = cv2.getPerspectiveTransform(plane_points, image_points)
+            inliers = np.ones(4, bool)
+        else:
+            # fitted plane -> image, so the threshold is in pixels
+            H_inv, mask = cv2.findHomography(plane_points, image_points, ROBUST_METHOD, threshold)
+            if H_inv is None:
+                return None
+            inliers = mask.reshape(-1).astype(bool)
+    if inliers.sum() < 4 or abs(np.linalg.det(H_inv)) < 1e-12:
+        return None
+
+    reprojected = geometry.project(H_inv[None], plane_points[inliers][None])[0]
+    rms = float(np.sqrt(((reprojected - image_points[inliers]) ** 2).sum(axis=1).mean()))
+    H = np.linalg.inv(H_inv)
+    return H / H[2, 2], inliers, rms
+
+def qr_correspondences(gray, quad, real_width, real_height):
+    '''
+    (image points, plane points) of a QR code: its finder pattern corners
+    when they are found, else only its outer corners.
+    '''
+    from qr_code_detection import finder_points
+
+    found = finder_points(gray, quad)
+    image_points, unit_points = found if found is not None else (quad, UNIT_SQUARE)
+    return np.float32(image_points), np.float32(unit_points) * [real_width, real_height]
+
+def target_correspondences(store, frame, real_width, real_height):
+    '''
+    (image points, plane points) of all matches with a saved feature target,
+    whose quad is real_width x real_height. None if it is not found.
+    '''
+    matched = store.matches(frame)
+    if matched is None:
+        return None
+    target_points, image_points = matched
+    origin, extent = store.quad[0], store.quad[2] - store.quad[0]
+    plane_points = (target_points - origin) / extent * [real_width, real_height]
+    return np.float32(image_points), np.float32(plane_points)
+
+def book_estimate(H, plane_points, image_points, size, corner_sigma=0.5):
+    '''
+    Real width and height of the book, with standard deviations, from one
+    reference. H rectifies the book onto a size rectangle (see
+    geometry.measure_quads); the reference points are mapped through it, and
+    the least squares affine map from their plane coordinates gives the
+    rectified pixels per real unit along each book axis (the row norms of
+    A = diag(sx, sy) R, so the reference may be rotated on the cover).
+    corner_sigma (image pixels) is the smallest point error assumed.
+    '''
+    rectified = geometry.project(H[None], image_points[None])[0]
+    X = np.hstack([plane_points, np.ones((len(plane_points), 1))])
+    A, residuals = np.linalg.lstsq(X, rectified, rcond=None)[:2]
+    A = A[:2].T
+    per_unit = np.linalg.norm(A, axis=1)
+
+    # rectified pixels per image pixel around the reference
+    local = (np.linalg.det(np.cov(rectified.T)) / np.linalg.det(np.cov(image_points.T))) ** 0.25
+    dof = max(len(X) - 3, 1)
+    variance = max(residuals.sum() / (2 * dof) if len(residuals) else 0.0, (local * corner_sigma) ** 2)
+    cov = variance * np.linalg.inv(X.T.dot(X))[:2, :2]
+    # first order error of each row norm
+    per_unit_std = np.array([np.sqrt(u.dot(cov).dot(u)) for u in A / per_unit[:, None]])
+
+    book = geometry.edge_lengths(geometry.rectangle(size))[0]
+    width, height = book[0] / per_unit[0], book[2] / per_unit[1]
+    return {
+        'width': float(width), 'height': float(height),
+        'width_std': float(width * per_unit_std[0] / per_unit[0]),
+        'height_std': float(height * per_unit_std[1] / per_unit[1]),
+    }
+
+def measure_robust(book_quad, references, size=(300, 400), threshold=1.0, corner_sigma=0.5):
+    '''
+    Fused book dimensions from one or more references, each given as
+    (image points, plane points). Outliers are dropped per reference with a
+    robust plane homography. Returns a dict with the fused width and height,
+    width_std and height_std, top, bottom, left and right (equal to width and
+    height: the book is rectified to a rectangle) and per reference fit
+    statistics. Raises ValueError if no reference gives a homography.
+    '''
+    H = geometry.homographies(book_quad, geometry.rectangle(size))[0]
+    if not np.all(np.isfinite(H)):
+        raise ValueError("Degenerate book corners.")
+
+    estimates, fits = [], []
+    for image_points, plane_points in references:
+        image_points = np.float64(image_points).reshape(-1, 2)
+        plane_points = np.float64(plane_points).reshape(-1, 2)
+        fitted = plane_homography(image_points, plane_points, threshold)
+        if fitted is None:
+            continue
+        inliers, rms = fitted[1], fitted[2]
+        estimate = book_estimate(H, plane_points[inliers], image_points[inliers], size, corner_sigma)
+        estimates.append(estimate)
+        fits.append({'points': int(len(inliers)), 'inliers': int(inliers.sum()), 'rms': rms,
+                     'width': estimate['width'], 'height': estimate['height']})
+    if not estimates:
+        raise ValueError("No reference homography could be fitted.")
+
+    result = {'references': fits}
+    for key in ('width', 'height'):
+        mean, sigma = geometry.fuse([e[key] for e in estimates], [e[key + '_std'] for e in estimates])
+        result[key], result[key + '_std'] = float(mean), float(sigma)
+    result['top'] = result['bottom'] = result['width']
+    result['left'] = result['right'] = result['height']
+    return result
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+'''
+Book Dimension Measurement Service
+==================
+
+Long running local HTTP service: OpenCV, the QR detector and the measurement
+code are imported and warmed up once at startup, instead of on every script
+invocation. Images are POSTed, dimensions come back as JSON.
+
+Requests are handled on threads. Decoding and finding the reference run per
+request; the homography and measurement of all requests arriving within
+--max_wait milliseconds of each other are done in one vectorized call
+(geometry.measure_quads), up to --max_batch at a time.
+
+Requests
+--------
+POST /measure?book=x0,y0,x1,y1,x2,y2,x3,y3[&reference=...][&qr_size=4 | &real_width=..&real_height=..][&scale=0.125]
+    body: the encoded image (JPEG, PNG, ...)
+    book and reference corners are in full resolution image coordinates,
+    top left -> top right -> bottom right -> bottom left. Without reference
+    the QR code in the image is used; with --table or --payload_size its
+    payload is decoded on the full resolution upload when the working scale
+    is too small. Bodies larger than --max_body MB are refused (413).
+GET /health
+
+Usage
+-----
+server.py [--host 127.0.0.1] [--port 8080 | --socket <path>] [--scale 0.125]
+          [--qr_size <qr_size>] [--table <sizes.json> | --payload_size]
+          [--max_batch 32] [--max_wait 5] [--max_body 64]
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+import geometry
+import measure
+import reference_table
+from utils import decode_image
+
+class Batcher(object):
+    '''
+    Collects measurement jobs from many threads and runs them together.
+    A batch is started once max_batch jobs are waiting, or max_wait seconds
+    after the first one arrived.
+    '''
+    def __init__(self, max_batch=32, max_wait=0.005, size=measure.DEST_SIZE):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.size = size
+        self.jobs = []
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def measure(self, book_quad, ref_quad, real_width, real_height):
+        '''
+        Blocks until the job's batch is done; returns the geometry results of
+        this job as a dict of floats and lists.
+        '''
+        job = {'args': (book_quad, ref_quad, real_width, real_height),
+               'done': threading.Event()}
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify()
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['result']
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                deadline = time.time() + self.max_wait
+                while len(self.jobs) < self.max_batch:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+                batch, self.jobs = self.jobs[:self.max_batch], self.jobs[self.max_batch:]
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            books, refs, widths, heights = [np.array(a, dtype=float) for a in zip(*[j['args'] for j in batch])]
+            m = geometry.measure_quads(books, refs, widths, heights, self.size)
+        except Exception as e:
+            for job in batch:
+                job['error'] = e
+                job['done'].set()
+            return
+
+        for i, job in enumerate(batch):
+            lengths = [float(m[k][i]) for k in ('top', 'bottom', 'left', 'right')]
+            if not np.all(np.isfinite(lengths)) or not np.all(np.isfinite(m['homography'][i])):
+                job['error'] = ValueError("Degenerate book or reference corners.")
+            else:
+                job['result'] = dict(zip(('top', 'bottom', 'left', 'right'), lengths),
+                                     homography=m['homography'][i].tolist(),
+                                     book_edges=m['book_edges'][i].tolist(),
+                                     reference_edges=m['reference_edges'][i].tolist())
+            job['done'].set()
+
+class Service(object):
+    '''
+    Measurement of one uploaded image, with the server wide defaults.
+    '''
+    def __init__(self, batcher, scale=0.125, real_width=None, real_height=None, sizes=None):
+        self.batcher = batcher
+        self.scale = scale
+        self.real_width = real_width
+        self.real_height = real_height
+        self.sizes = sizes
+
+    def measure(self, data, params):
+        scale = float(params.get('scale', self.scale))
+        real_width = float(params['real_width']) if 'real_width' in params else self.real_width
+        real_height = float(params['real_height']) if 'real_height' in params else self.real_height
+        if 'qr_size' in params:
+            real_width = real_height = float(params['qr_size'])
+        if 'book' not in params:
+            raise ValueError("book corners are required")
+        book_quad = parse_quad(params['book']) * scale
+
+        if not data:
+            raise ValueError("empty image")
+        image = decode_image(data, scale)
+        if image is None:
+            raise ValueError("could not decode the image")
+
+        payload = None
+        if 'reference' in params:
+            ref_quad = parse_quad(params['reference']) * scale
+        elif self.sizes is not None:
+            ref_quad, payload = measure.find_qr_reference(image, need_payload=True)
+            if payload is None:
+                # the modules are often too small to decode at working scale
+                gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+                if gray is not None:
+                    payload = measure.read_payloads(None, image, [ref_quad], gray)[0]
+            real_width, real_height = measure.reference_size(payload, self.sizes, real_width, real_height)
+        else:
+            ref_quad = measure.find_qr_reference(image)
+        if real_width is None or real_height is None:
+            raise ValueError("real reference size unknown, give qr_size or real_width and real_height")
+
+        result = {'book_quad': book_quad.tolist(), 'reference_quad': np.asarray(ref_quad).tolist()}
+        result.update(self.batcher.measure(book_quad, ref_quad, real_width, real_height))
+        if payload is not None:
+            result['payload'] = payload.decode('utf-8', 'replace')
+        result['real_width'], result['real_height'] = float(real_width), float(real_height)
+        return result
+
+    def warm_up(self):
+        '''
+        Run every stage once on a synthetic image, so the first request does
+        not pay for lazy initialisation (imports, QR detector, numpy paths).
+        '''
+        from qr_code_detection import opencv_detector
+
+        opencv_detector()
+        image = np.full((64, 64, 3), 255, np.uint8)
+        try:
+            measure.find_qr_reference(image)
+        except measure.ReferenceNotFound:
+            pass
+        square = np.array([[0, 0], [10, 0], [10, 10], [0, 10]], dtype=float)
+        self.batcher.measure(square * 4, square, 1.0, 1.0)
+
+def parse_quad(text):
+    values = [float(v) for v in text.split(',')]
+    if len(values) != 8:
+        raise ValueError("corners need 8 comma separated numbers, got %d" % len(values))
+    return np.array(values).reshape(4, 2)
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+    max_body = 64 * 1024 * 1024
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {'status': 'error', 'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/measure':
+            self.reply(404, {'status': 'error', 'error': 'not found'})
+            return
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= self.max_body:
+            # the body is not read, the connection cannot be reused
+            self.close_connection = True
+            if length < 0:
+                self.reply(400, {'status': 'error', 'error': 'invalid Content-Length'})
+            else:
+                self.reply(413, {'status': 'error', 'error': 'body larger than %d bytes' % self.max_body})
+            return
+        data = self.rfile.read(length)
+        try:
+            result = self.service.measure(data, params)
+        except measure.ReferenceNotFound as e:
+            self.reply(422, {'status': 'error', 'error': str(e), 'no_reference': True})
+            return
+        except ValueError as e:
+            self.reply(400, {'status': 'error', 'error': str(e)})
+            return
+        except Exception as e:
+            self.reply(500, {'status': 'error', 'error': str(e)})
+            return
+        result['status'] = 'ok'
+        self.reply(200, result)
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        print("%s %s" % (self.address_string(), format % args), file=sys.stderr)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Book dimension measurement service")
+    ap.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    ap.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    ap.add_argument("--socket", help="Listen on this Unix socket instead of a TCP port")
+    ap.add_argument("-s", "--scale", type=float, default=0.125, help="Default working resolution scale")
+    ap.add_argument("-w", "--real_width", type=float, help="Default real reference width")
+    ap.add_argument("-H", "--real_height", type=float, help="Default real reference height")
+    ap.add_argument("--qr_size", type=float, help="Default real side length of the printed QR code")
+    ap.add_argument("--table", help="JSON/CSV table of QR payload -> real reference size")
+    ap.add_argument("--payload_size", action="store_true",
+                    help="Read the real reference size from the QR payload (e.g. REF-4cm), "
+                         "with --table for payloads not in it")
+    ap.add_argument("--max_batch", type=int, default=32, help="Most requests measured in one call")
+    ap.add_argument("--max_wait", type=float, default=5.0,
+                    help="Milliseconds to wait for more requests before measuring a batch")
+    ap.add_argument("--max_body", type=float, default=64, help="Largest accepted upload in MB")
+    args = ap.parse_args(argv)
+
+    if args.qr_size is not None:
+        args.real_width = args.real_height = args.qr_size
+    sizes = reference_table.load_sizes(args.table, args.payload_size)
+
+    batcher = Batcher(args.max_batch, args.max_wait / 1000.0)
+    service = Service(batcher, args.scale, args.real_width, args.real_height, sizes)
+    start = time.time()
+    service.warm_up()
+    print("Warmed up in %.1f ms" % ((time.time() - start) * 1000), file=sys.stderr)
+
+    Handler.service = service
+    Handler.max_body = int(args.max_body * 1024 * 1024)
+    if args.socket:
+        if os.path.exists(args.socket) and stat.S_ISSOCK(os.stat(args.socket).st_mode):
+            # left over from an earlier run
+            os.unlink(args.socket)
+        httpd = ThreadingUnixHTTPServer(args.socket, Handler)
+        print("Listening on %s" % args.socket, file=sys.stderr)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), Handler)
+        print("Listening on http://%s:%d" % (args.host, args.port), file=sys.stderr)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+'''
+Streaming Book Dimension Measurement
+==================
+
+Measures a book in a video file or camera stream. The expensive detection (QR
+code and book cover) only runs on keyframes; between keyframes the book
+and reference corners are tracked with pyramidal Lucas-Kanade optical flow, and
+the edge lengths are computed from the tracked corners (no warping). A smoothed
+estimate (exponential moving average) is emitted for every processed frame.
+
+A new keyframe is taken every --keyframe frames, or earlier when tracking is lost.
+For cameras, frames are read on a separate thread and only the newest one is kept,
+so frames are dropped instead of queueing up when measuring falls behind.
+
+The book corners of the first frame come from --quads (same sidecar as measure.py,
+in full resolution coordinates of the stream); the reference comes from the sidecar
+or, with --qr, from the QR code found on each keyframe. On every keyframe the cover
+is detected again (cover_detection.detect_cover), which corrects tracking drift: a
+detection is used when its confidence is at least --min_confidence and it overlaps
+the tracked corners. After tracking is lost the tracked corners are stale, so a
+confident detection is used as it is and the sidecar corners otherwise.
+
+Usage
+-----
+stream.py --source [<video file or camera index>] --quads [<sidecar>]
+          (--real_width <w> --real_height <h> | --qr --qr_size <qr_size>)
+          [--scale 1.0] [--keyframe 15] [--smoothing 0.2] [--min_confidence 0.5] [--drop | --no-drop]
+'''
+# Python 2/3 compatibility
+from __future__ import print_function
+import argparse
+import json
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+
+import geometry
+import instrument
+import measure
+
+class LatestFrameReader(object):
+    '''
+    Reads frames on a background thread, keeping only the newest one.
+    read() blocks until a frame newer than the last returned one is available.
+    '''
+    def __init__(self, cap):
+        self.cap = cap
+        self.cond = threading.Condition()
+        self.frame = None
+        self.index = -1
+        self.returned = -1
+        self.done = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            ret, frame = self.cap.read()
+            with self.cond:
+                if not ret:
+                    self.done = True
+                    self.cond.notify_all()
+                    return
+                if self.index > self.returned:
+                    self.dropped += 1
+                self.frame = frame
+                self.index += 1
+                self.cond.notify_all()
+
+    def read(self):
+        with self.cond:
+            while self.index == self.returned and not self.done:
+                self.cond.wait()
+            if self.index == self.returned:
+                return None, None
+            self.returned = self.index
+            return self.index, self.frame
+
+class QuadTracker(object):
+    '''
+    Tracks quads between frames with sparse optical flow and a RANSAC homography.
+    '''
+    def __init__(self, min_points=12):
+        self.min_points = min_points
+        self.prev_gray = None
+        self.points = None
+        self.lk_params = dict(winSize=(21, 21), maxLevel=3,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+    def reset(self, gray, quads):
+        '''
+        Pick features to track inside the given quads.
+        '''
+        mask = np.zeros(gray.shape[:2], np.uint8)
+        for quad in quads:
+            cv2.fillConvexPoly(mask, np.int32(np.round(quad)), 255)
+        self.points = cv2.goodFeaturesToTrack(gray, 200, 0.01, 7, mask=mask)
+        self.prev_gray = gray
+
+    def track(self, gray, quads):
+        '''
+        Move the quads to the new frame. Returns None when tracking is lost.
+        '''
+        if self.points is None or len(self.points) < self.min_points:
+            return None
+        p1, status, err = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, self.points, None, **self.lk_params)
+        good = status.reshape(-1) == 1
+        if good.sum() < self.min_points:
+            return None
+        H, inliers = cv2.findHomography(self.points[good], p1[good], cv2.RANSAC, 3.0)
+        if H is None:
+            return None
+
+        self.prev_gray = gray
+        self.points = p1[good][inliers.reshape(-1) == 1].reshape(-1, 1, 2)
+        return [cv2.perspectiveTransform(np.float32(q).reshape(-1, 1, 2), H).reshape(4, 2) for q in quads]
+
+class StreamMeasurer(object):
+    '''
+    Keyframe detection + tracking + smoothing over a sequence of frames.
+    detect(frame, book_quad, ref_quad) returns the (book_quad, ref_quad) of a
+    keyframe, given the current tracked estimates (None after tracking was
+    lost), or raises ValueError.
+    '''
+    def __init__(self, detect, real_width, real_height, keyframe=15, smoothing=0.2):
+        self.detect = detect
+        self.real_width = real_width
+        self.real_height = real_height
+        self.keyframe = keyframe
+        self.smoothing = smoothing
+        self.tracker = QuadTracker()
+        self.book_quad = None
+        self.ref_quad = None
+        self.since_keyframe = None
+        self.smoothed = None
+
+    def process(self, frame):
+        '''
+        Measure one frame, returns a record dict.
+        '''
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        quads = None
+        if self.since_keyframe is not None and self.since_keyframe < self.keyframe:
+            with instrument.stage('track'):
+                quads = self.tracker.track(gray, [self.book_quad, self.ref_quad])
+            if quads is None:
+                # lost: the last tracked corners are stale
+                self.reset()
+
+        keyframe = quads is None
+        if keyframe:
+            with instrument.stage('detect'):
+                book_quad, ref_quad = self.detect(frame, self.book_quad, self.ref_quad)
+            quads = [np.asarray(book_quad, float), np.asarray(ref_quad, float)]
+            self.tracker.reset(gray, quads)
+            self.since_keyframe = 0
+        self.since_keyframe += 1
+        self.book_quad, self.ref_quad = quads
+
+        with instrument.stage('measure'):
+            m = geometry.measure_quads(self.book_quad, self.ref_quad, self.real_width, self.real_height)
+        lengths = np.array([m['top'][0], m['bottom'][0], m['left'][0], m['right'][0]])
+        if self.smoothed is None or not np.isfinite(self.smoothed).all():
+            self.smoothed = lengths
+        else:
+            self.smoothed = self.smoothing * lengths + (1 - self.smoothing) * self.smoothed
+
+        names = ('top', 'bottom', 'left', 'right')
+        return {
+            'status': 'ok',
+            'keyframe': keyframe,
+            'book_quad': self.book_quad.tolist(),
+            'raw': dict(zip(names, lengths.tolist())),
+            'smoothed': dict(zip(names, self.smoothed.tolist())),
+        }
+
+    def reset(self):
+        '''
+        Forget the tracked corners, the next frame is a keyframe detected from scratch.
+        '''
+        self.book_quad = self.ref_quad = None
+        self.since_keyframe = None
+
+def make_detector(book_quad, ref_quad, qr, min_confidence=0.5):
+    '''
+    Keyframe detector: the QR reference is re-detected with --qr, the book
+    cover is re-detected on every keyframe. A confident detection replaces
+    the tracked corners if it overlaps them, or is taken as it is when there
+    are none (first frame, tracking lost); otherwise the tracked corners, or
+    the sidecar corners, are kept.
+    '''
+    import cover_detection
+
+    def detect(frame, tracked_book, tracked_ref):
+        ref = measure.find_qr_reference(frame) if qr else (tracked_ref if tracked_ref is not None else ref_quad)
+        if ref is None:
+            raise ValueError("No reference corners given.")
+        book = tracked_book if tracked_book is not None else book_quad
+        quad, confidence = cover_detection.detect_cover(frame, ref)
+        if quad is not None and confidence >= min_confidence and \
+                (tracked_book is None or cover_detection.quad_iou(quad, tracked_book) > 0.5):
+            book = quad
+        return book, ref
+    return detect
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Streaming book dimension measurement")
+    ap.add_argument("-i", "--source", required=True, help="Video file, or camera index")
+    ap.add_argument("-q", "--quads", required=True, help="Sidecar JSON/CSV with the first frame corners")
+    ap.add_argument("-w", "--real_width", type=float, help="Real Width")
+    ap.add_argument("-H", "--real_height", type=float, help="Real Height")
+    ap.add_argument("--qr", action="store_true", help="Detect the QR code as reference on keyframes")
+    ap.add_argument("--qr_size", type=float, help="Real side length of the printed QR code")
+    ap.add_argument("-s", "--scale", type=float, default=1.0, help="Working resolution scale")
+    ap.add_argument("-k", "--keyframe", type=int, default=15, help="Frames between keyframes")
+    ap.add_argument("--smoothing", type=float, default=0.2, help="Weight of the newest frame in the estimate")
+    ap.add_argument("--min_confidence", type=float, default=0.5,
+                    help="Keyframe cover detections below this confidence are not used")
+    ap.add_argument("--drop", dest="drop", action="store_true", default=None,
+                    help="Drop frames when measuring falls behind (default for cameras)")
+    ap.add_argument("--no-drop", dest="drop", action="store_false", help="Process every frame")
+    args = ap.parse_args(argv)
+
+    if args.qr:
+        if args.qr_size is None:
+            ap.error("--qr requires --qr_size")
+        args.real_width = args.real_height = args.qr_size
+    elif args.real_width is None or args.real_height is None:
+        ap.error("--real_width and --real_height are required without --qr")
+
+    camera = args.source.isdigit()
+    cap = cv2.VideoCapture(int(args.source) if camera else args.source)
+    if not cap.isOpened():
+        print("Could not open video source: %s" % args.source, file=sys.stderr)
+        return 1
+    drop = camera if args.drop is None else args.drop
+
+    book_quad, ref_quad = measure.load_quads(args.quads)
+    detect = make_detector(book_quad * args.scale,
+                           ref_quad * args.scale if ref_quad is not None else None, args.qr,
+                           args.min_confidence)
+    measurer = StreamMeasurer(detect, args.real_width, args.real_height, args.keyframe, args.smoothing)
+
+    reader = LatestFrameReader(cap) if drop else None
+    index = -1
+    start = time.time()
+    while True:
+        if reader is not None:
+            index, frame = reader.read()
+        else:
+            ret, frame = cap.read()
+            index = index + 1 if ret else None
+        if index is None:
+            break
+        if args.scale != 1:
+            frame = cv2.resize(frame, (0, 0), fx=args.scale, fy=args.scale, interpolation=cv2.INTER_AREA)
+
+        try:
+            record = measurer.process(frame)
+        except (ValueError, cv2.error) as e:
+            record = {'status': 'error', 'error': str(e)}
+            # detect again on the next frame
+            measurer.reset()
+        record['frame'] = index
+        record['time'] = time.time() - start
+        if reader is not None:
+            record['dropped'] = reader.dropped
+        print(json.dumps(record))
+        sys.stdout.flush()
+
+    cap.release()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
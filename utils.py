@@ -5,10 +5,17 @@ Available functions:
 2) Average Calculation
 3) Mouse Handling, (Left Button Clicked Once)
 4) Get four points from the user
+5) Order corner points (top left -> top right -> bottom right -> bottom left)
+6) Image loading with decode time downscaling
+7) Sub-pixel refinement of corners found at a lower resolution
+8) Image decoding from memory-mapped files or bytes
 '''
 import math
+import mmap
+import struct
 import cv2
 import numpy as np
+import instrument
 
 def distance(x, y):
     return math.sqrt((x[0] - y[0])**2 + (x[1] - y[1])**2)
@@ -18,6 +25,9 @@ def avg(x, y):
 
 def mouse_handler(event, x, y, flags, data) :
     if event == cv2.EVENT_LBUTTONDOWN :
+        if not data.get('copied', True):
+            data['im'] = data['im'].copy()
+            data['copied'] = True
         cv2.circle(data['im'], (x,y), 3, (0,0,255), 1, 1);
         cv2.imshow("Image", data['im']);
         if len(data['points']) < 4 :
@@ -27,7 +37,9 @@ def get_four_points(im):
 
     # Set up data to send to mouse handler
     data = {}
-    data['im'] = im.copy()
+    # copied on the first click, only once something is drawn on it
+    data['im'] = im
+    data['copied'] = False
     data['points'] = []
 
     #Set the callback function for any mouse event
@@ -38,4 +50,185 @@ def get_four_points(im):
     # Convert array to np.array
     points = np.vstack(data['points']).astype(float)
 
-    return points
\ No newline at end of file
+    return points
+
+def extreme_corners(hull):
+    '''
+    The four points of a convex hull closest to the corners of its minimum
+    area rectangle, each point used once.
+    '''
+    box = cv2.boxPoints(cv2.minAreaRect(np.float32(hull)))
+    corners, free = [], np.ones(len(hull), bool)
+    for corner in box:
+        distance = np.linalg.norm(hull - corner, axis=1)
+        distance[~free] = np.inf
+        i = int(np.argmin(distance))
+        free[i] = False
+        corners.append(hull[i])
+    return np.float32(corners)
+
+def order_points(points):
+    '''
+    Order four corner points as top left -> top right -> bottom right -> bottom left.
+    Polygons with more than four points (e.g. zbar locations) are reduced to
+    their four extreme corners first.
+    '''
+    pts = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+    if len(pts) > 4:
+        hull = cv2.convexHull(pts).reshape(-1, 2)
+        approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True).reshape(-1, 2)
+        pts = approx if len(approx) == 4 else hull
+        if len(pts) > 4:
+            pts = extreme_corners(pts)
+    if len(pts) < 4:
+        raise ValueError("At least 4 points are required, got %d" % len(pts))
+
+    # clockwise (in image coordinates) around the centre, starting from the
+    # corner with the smallest x + y (top left)
+    center = pts.mean(axis=0)
+    pts = pts[np.argsort(np.arctan2(pts[:, 1] - center[1], pts[:, 0] - center[0]))]
+    start = np.argmin(pts.sum(axis=1))
+    return np.roll(pts, -start, axis=0).astype(float)
+
+
+# JPEG decoders can downscale by these factors while decoding (DCT scaling),
+# other formats are decoded and downscaled inside imread.
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def image_size(path):
+    '''
+    (width, height) of a JPEG or PNG file read from its header, without
+    decoding the pixels. Returns None for other or broken files.
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) == 24:
+            return struct.unpack('>II', head[16:24])
+        if head[:2] != b'\xff\xd8':
+            return None
+
+        f.seek(2)
+        while True:
+            byte = f.read(1)
+            if not byte:
+                return None
+            if byte != b'\xff':
+                continue
+            marker = f.read(1)
+            while marker == b'\xff':
+                marker = f.read(1)
+            if not marker:
+                return None
+            code = ord(marker)
+            # standalone markers have no length field
+            if code == 0x01 or 0xd0 <= code <= 0xd9 or code == 0x00:
+                continue
+            length = f.read(2)
+            if len(length) != 2:
+                return None
+            length = struct.unpack('>H', length)[0]
+            # start of frame (baseline, progressive, ...) holds the size
+            if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                data = f.read(5)
+                if len(data) != 5:
+                    return None
+                height, width = struct.unpack('>HH', data[1:5])
+                return width, height
+            f.seek(length - 2, 1)
+
+def working_scale(path, max_side):
+    '''
+    Scale factor which brings the longer side of the image down to max_side
+    (never upscales). Returns 1.0 if the size cannot be read from the header.
+    '''
+    size = image_size(path)
+    if size is None or max(size) <= max_side:
+        return 1.0
+    return float(max_side) / max(size)
+
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    '''
+    Decode an image file straight from a memory map of it, same as
+    cv2.imread(path, flags) without reading the file into a bytes copy first.
+    Returns None if the image cannot be read.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # missing or empty file
+        return None
+    data = None
+    try:
+        data = np.frombuffer(mapped, np.uint8)
+        img = cv2.imdecode(data, flags)
+    finally:
+        # the map cannot be closed while an array still points into it, also
+        # when imdecode raised
+        del data
+        mapped.close()
+    return img
+
+def load_image(path, scale=1.0):
+    '''
+    Read an image already downscaled by scale, same as cv2.imread followed by
+    cv2.resize(..., fx=scale, fy=scale) but without decoding at full resolution.
+    Returns None if the image cannot be read.
+    '''
+    return _decode_scaled(lambda flag: read_image(path, flag), scale)
+
+def decode_image(data, scale=1.0):
+    '''
+    Same as load_image, on the encoded bytes of an image (e.g. an upload).
+    '''
+    buf = np.frombuffer(data, np.uint8)
+    return _decode_scaled(lambda flag: cv2.imdecode(buf, flag), scale)
+
+def _decode_scaled(decode, scale):
+    factor = 1
+    flag = cv2.IMREAD_COLOR
+    for reduction, reduced_flag in REDUCED_FLAGS:
+        if scale * reduction <= 1.0 + 1e-6:
+            factor, flag = reduction, reduced_flag
+            break
+
+    with instrument.stage('decode'):
+        img = decode(flag)
+    if img is None:
+        return None
+
+    # remaining downscaling, after the decoder's own reduction
+    rest = scale * factor
+    if abs(rest - 1.0) > 1e-6:
+        with instrument.stage('resize'):
+            img = cv2.resize(img, (0, 0), fx=rest, fy=rest, interpolation=cv2.INTER_AREA)
+    return img
+
+def refine_corners(gray, quad, scale):
+    '''
+    Refine corners found at the given working scale on the full resolution
+    grayscale image. quad is in full resolution coordinates; only a small
+    window around each corner is looked at.
+    '''
+    # a corner found at scale s is off by up to about 1/s full resolution pixels
+    win = max(3, int(round(1.0 / scale)))
+    radius = 4 * win
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    h, w = gray.shape[:2]
+
+    refined = []
+    for x, y in np.asarray(quad, dtype=float).reshape(-1, 2):
+        x0, y0 = max(int(x) - radius, 0), max(int(y) - radius, 0)
+        x1, y1 = min(int(x) + radius + 1, w), min(int(y) + radius + 1, h)
+        roi = gray[y0:y1, x0:x1]
+        if (roi.shape[0] < 2 * win + 5 or roi.shape[1] < 2 * win + 5 or
+                not (x0 <= x < x1 and y0 <= y < y1)):
+            # outside or too close to the border, keep the coarse corner
+            refined.append([x, y])
+            continue
+        pt = np.array([[[x - x0, y - y0]]], dtype=np.float32)
+        cv2.cornerSubPix(roi, pt, (win, win), (-1, -1), criteria)
+        refined.append([pt[0, 0, 0] + x0, pt[0, 0, 1] + y0])
+    return np.array(refined, dtype=float)